@@ -0,0 +1,319 @@
+""" Benchmarks for the pyramid_webpack hot paths """
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+from pyramid.config import Configurator
+from pyramid.scripting import prepare
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Benchmark the checkout even if pyramid_webpack isn't installed
+sys.path.insert(0, os.path.dirname(HERE))
+
+from pyramid_webpack import Webpack, WebpackState, streaming  # noqa: E402 pylint: disable=C0413
+
+RESULTS_DIR = os.path.join(HERE, 'results')
+
+STATS_SIZES = {
+    '10kb': 10 * 1024,
+    '1mb': 1024 * 1024,
+    '10mb': 10 * 1024 * 1024,
+    '50mb': 50 * 1024 * 1024,
+}
+QUICK_STATS_SIZES = ('10kb', '1mb')
+
+
+def make_stats(num_bundles=10, chunks_per_bundle=20, size=None):
+    """
+    Generate webpack-bundle-tracker stats data
+
+    If ``size`` is given, the stats are padded with module info until the
+    serialized JSON is about that many bytes.
+
+    """
+    chunks = {}
+    for i in range(num_bundles):
+        bundle = []
+        for j in range(chunks_per_bundle):
+            bundle.append({
+                'name': 'bundle{0}.chunk{1}.0123456789abcdef.js'.format(i, j),
+                'path': '/static/bundle{0}.chunk{1}.js'.format(i, j),
+            })
+            bundle.append({
+                'name': 'bundle{0}.chunk{1}.js.map'.format(i, j),
+                'path': '/static/bundle{0}.chunk{1}.js.map'.format(i, j),
+            })
+        bundle.append({
+            'name': 'bundle{0}.css'.format(i),
+            'path': '/static/bundle{0}.css'.format(i),
+        })
+        chunks['bundle{0}'.format(i)] = bundle
+    stats = {'status': 'done', 'chunks': chunks}
+    if size is not None:
+        base_size = len(json.dumps(stats))
+        module = {
+            'id': './node_modules/some-library/lib/module.js',
+            'size': 12345,
+            'reasons': ['./src/index.js', './src/other.js'],
+        }
+        module_size = len(json.dumps(module)) + 2
+        count = max(0, (size - base_size) // module_size)
+        stats['modules'] = [module] * count
+    return stats
+
+
+class Benchmarks(object):
+
+    """ Runs the benchmarks and collects the results """
+
+    def __init__(self, quick=False, repeat=5):
+        self.quick = quick
+        self.repeat = repeat
+        self.results = {}
+        self._tempdir = tempfile.mkdtemp()
+
+    def close(self):
+        """ Clean up the temporary files """
+        shutil.rmtree(self._tempdir)
+
+    def _write(self, filename, data):
+        """ Write json data to a temporary file """
+        fullpath = os.path.join(self._tempdir, filename)
+        with open(fullpath, 'w') as ofile:
+            json.dump(data, ofile)
+        return fullpath
+
+    def _time(self, name, func, number=None):
+        """ Record the best time per call of a function """
+        if number is None:
+            # Aim for roughly 0.2 seconds per measurement
+            number = 1
+            while number < 1000000:
+                if timeit.timeit(func, number=number) > 0.2:
+                    break
+                number *= 10
+        best = min(timeit.repeat(func, number=number, repeat=self.repeat))
+        self.results[name] = best / number
+        print("{0:<45} {1:>12.3f} us".format(name, 1e6 * best / number))
+
+    def _make_app(self, settings):
+        """ Create a pyramid registry with pyramid_webpack included """
+        settings = dict(settings)
+        settings.setdefault('pyramid.includes', ['pyramid_jinja2',
+                                                 'pyramid_webpack'])
+        settings.setdefault('jinja2.extensions',
+                            ['pyramid_webpack.jinja2ext:WebpackExtension'])
+        config = Configurator(settings=settings)
+        config.commit()
+        return config.registry
+
+    def bench_load_stats(self):
+        """ Parsing stats files of various sizes """
+        sizes = QUICK_STATS_SIZES if self.quick else sorted(
+            STATS_SIZES, key=STATS_SIZES.get)
+        for size_name in sizes:
+            stats_file = self._write('stats-{0}.json'.format(size_name),
+                                     make_stats(size=STATS_SIZES[size_name]))
+            state = WebpackState({'webpack.stats_file': stats_file})
+            number = 1 if STATS_SIZES[size_name] > 1024 * 1024 else None
+            self._time('load_stats[{0}]'.format(size_name), state._load_stats,
+                       number)
+            if streaming.ijson is not None:
+                state = WebpackState({'webpack.stats_file': stats_file,
+                                      'webpack.stream_stats': True})
+                self._time('load_stats[{0},stream]'.format(size_name),
+                           state._load_stats, number)
+
+    def bench_get_bundle(self):
+        """ Resolving bundles with many chunks and ignore patterns """
+        stats_file = self._write('stats-bundle.json',
+                                 make_stats(num_bundles=10,
+                                            chunks_per_bundle=100))
+        settings = {
+            'webpack.stats_file': stats_file,
+            'webpack.ignore': ['*.hot-update.js', '*.map'] +
+                              ['*.ignore{0}.js'.format(i) for i in range(20)],
+            'webpack.ignore_re': [r'.*\.skip{0}\.js$'.format(i)
+                                  for i in range(20)],
+        }
+        registry = self._make_app(settings)
+        env = prepare(registry=registry)
+        try:
+            request = env['request']
+            state = registry.webpack['DEFAULT']
+
+            def cold():
+                """ Build the index from scratch """
+                state.load_stats(cache=False)
+                Webpack(request).get_bundle('bundle0')
+
+            def warm():
+                """ Resolve a bundle from a fresh request """
+                Webpack(request).get_bundle('bundle0')
+
+            def warm_ext():
+                """ Resolve a bundle filtered by extension """
+                Webpack(request).get_bundle('bundle0', '.css .js')
+
+            self._time('get_bundle[cold]', cold)
+            self._time('get_bundle[warm]', warm)
+            self._time('get_bundle[warm,extensions]', warm_ext)
+        finally:
+            env['closer']()
+
+    def bench_render(self):
+        """ Rendering a jinja2 page with many webpack tags """
+        from pyramid.renderers import render
+        stats_file = self._write('stats-render.json', make_stats())
+        template_dir = os.path.join(self._tempdir, 'templates')
+        if not os.path.exists(template_dir):
+            os.makedirs(template_dir)
+        with open(os.path.join(template_dir, 'page.jinja2'), 'w') as ofile:
+            for i in range(10):
+                ofile.write(
+                    "{{% webpack 'bundle{0}', '.js' %}}"
+                    "<script src=\"{{{{ ASSET.url }}}}\"></script>"
+                    "{{% endwebpack %}}\n"
+                    "{{% webpack 'bundle{0}', '.css' %}}"
+                    "<link rel=\"stylesheet\" href=\"{{{{ ASSET.url }}}}\">"
+                    "{{% endwebpack %}}\n".format(i))
+        registry = self._make_app({
+            'webpack.stats_file': stats_file,
+            'jinja2.directories': [template_dir],
+        })
+        env = prepare(registry=registry)
+        try:
+            request = env['request']
+
+            def render_page():
+                """ Render the page for a fresh request """
+                request.__dict__.pop('_webpack_map', None)
+                render('page.jinja2', {}, request=request)
+
+            self._time('render[20 tags]', render_page)
+        finally:
+            env['closer']()
+
+    def bench_debug_threads(self):
+        """ Debug-mode get_bundle throughput with concurrent threads """
+        stats_file = self._write('stats-debug.json',
+                                 make_stats(size=STATS_SIZES['1mb']))
+        num_threads = 2 if self.quick else 8
+        duration = 0.5 if self.quick else 2
+        for reload_mode in ('always', 'stat'):
+            registry = self._make_app({
+                'webpack.stats_file': stats_file,
+                'webpack.debug': 'true',
+                'webpack.reload_mode': reload_mode,
+            })
+            counts = []
+            end = time.time() + duration
+
+            def run():
+                """ Resolve bundles until the time runs out """
+                env = prepare(registry=registry)
+                count = 0
+                try:
+                    while time.time() < end:
+                        env['request'].__dict__.pop('_webpack_map', None)
+                        env['request'].webpack().get_bundle('bundle0')
+                        count += 1
+                finally:
+                    env['closer']()
+                counts.append(count)
+
+            threads = [threading.Thread(target=run)
+                       for _ in range(num_threads)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            name = 'debug_threads[{0},{1} threads]'.format(reload_mode,
+                                                           num_threads)
+            # Store as seconds per call so that lower is better everywhere
+            self.results[name] = duration / max(1, sum(counts))
+            print("{0:<45} {1:>12.3f} us".format(name,
+                                                 1e6 * self.results[name]))
+
+    def run(self, names=None):
+        """ Run all (or some) of the benchmarks """
+        for attr in sorted(dir(self)):
+            if not attr.startswith('bench_'):
+                continue
+            if names and attr[len('bench_'):] not in names:
+                continue
+            getattr(self, attr)()
+        return self.results
+
+
+def compare(results, baseline, threshold):
+    """ Print the change from a baseline and return the regressions """
+    regressions = []
+    for name, value in sorted(results.items()):
+        old = baseline.get(name)
+        if old is None:
+            continue
+        ratio = value / old
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print("{0:<45} {1:>8.2f}x{2}".format(name, ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    """ Run the benchmarks from the command line """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('benchmarks', nargs='*',
+                        help="Only run these benchmarks (e.g. load_stats)")
+    parser.add_argument('--quick', action='store_true',
+                        help="Skip the largest stats files and shorten runs")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Number of measurements to take (default %(default)s)")
+    parser.add_argument('--save', metavar='NAME',
+                        help="Save the results to results/NAME.json")
+    parser.add_argument('--compare', metavar='NAME',
+                        help="Compare against results/NAME.json")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="Slowdown that counts as a regression "
+                        "(default %(default)s)")
+    args = parser.parse_args(argv)
+
+    benchmarks = Benchmarks(args.quick, args.repeat)
+    try:
+        results = benchmarks.run(args.benchmarks)
+    finally:
+        benchmarks.close()
+
+    if args.save:
+        if not os.path.exists(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        with open(os.path.join(RESULTS_DIR, args.save + '.json'), 'w') as ofile:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'time': time.time(),
+                'results': results,
+            }, ofile, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(os.path.join(RESULTS_DIR, args.compare + '.json'), 'r') as ifile:
+            baseline = json.load(ifile)['results']
+        print()
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
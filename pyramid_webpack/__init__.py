@@ -1,22 +1,64 @@
 """ pyramid_webpack """
+import atexit
 import fnmatch
+import hashlib
+import importlib
+import io
+import os
+import pkgutil
 import posixpath
 import re
+import threading
 import time
-from io import StringIO
 
 import json
 import six
-from pkg_resources import resource_string
 from pyramid.decorator import reify
+from pyramid.interfaces import IStaticURLInfo
 from pyramid.settings import asbool, aslist
 
+from .metrics import load_metrics
+from six.moves import intern  # pylint: disable=E0401
+from six.moves.urllib.parse import quote as url_quote, urlparse  # pylint: disable=E0401
+
 
 __version__ = '0.1.3'
 
 
 SENTINEL = object()
 
+# Placeholder file name used to find the static url prefix for a config
+URL_MARKER = '__webpack_url_marker__'
+
+# Maximum number of host-specific url entries to cache
+MAX_CACHED_URLS = 1000
+
+# Maximum number of threads used to preload stats files
+MAX_PRELOAD_THREADS = 8
+
+# Matches chunk names that contain a content hash (e.g. main.0a1b2c3d.js)
+DEFAULT_HASHED_RE = r'[.\-_][0-9a-fA-F]{8,}[.\-_]'
+
+# Stats keys that are kept in a StatsSnapshot, besides the chunks
+STATS_KEYS = ('status', 'error', 'message', 'hash')
+
+# Chunk keys whose string values are interned
+CHUNK_FIELDS = ('name', 'path', 'publicPath', 'url', 'integrity')
+
+# Maximum number of times to re-open a stats file that was replaced mid-read
+MAX_RENAME_RETRIES = 3
+
+
+class StatsInProgress(ValueError):
+
+    """ Raised when the stats file is being written and can't be read yet """
+
+
+def _stat_signature(st):
+    """ Get the (mtime, size, inode) signature from a stat result """
+    mtime = getattr(st, 'st_mtime_ns', st.st_mtime)
+    return (mtime, st.st_size, st.st_ino)
+
 
 @six.python_2_unicode_compatible
 class StaticResource(object):
@@ -33,30 +75,453 @@ class StaticResource(object):
         return cls(path)
 
     def open(self):
-        """ Open a stream object to the resource data """
+        """ Open a binary stream object to the resource data """
         if self.path.startswith('/'):
             # Absolute path
-            filepath = self.path
-            return open(filepath, 'r')
+            return open(self.path, 'rb')
         else:
             # Asset specification
-            package, filename = self.path.split(':')
-            contents = resource_string(package, filename)
-            return StringIO(contents.decode('utf-8'))
+            return io.BytesIO(self.read())
+
+    def read(self):
+        """ Read the resource data as bytes """
+        if self.path.startswith('/'):
+            with open(self.path, 'rb') as ifile:
+                return ifile.read()
+        package, filename = self.path.split(':')
+        data = pkgutil.get_data(package, filename)
+        if data is None:
+            raise IOError("Could not load resource {0}".format(self.path))
+        return data
+
+    def load_stable(self, load):
+        """
+        Load the resource data, checking that it wasn't being written
+
+        ``load`` is called with the open binary file. Returns a tuple of
+        (result, signature), where the signature is the :meth:`stat` of the
+        data that was loaded. Raises :class:`StatsInProgress` if the file is
+        empty or changed while it was being loaded. If the file was atomically
+        replaced (written to a temporary file and renamed) while it was being
+        loaded, the new file is loaded instead. Resources that are not plain
+        files are loaded from memory and have a signature of None.
+
+        """
+        filepath = self.filename()
+        if filepath is None:
+            return load(io.BytesIO(self.read())), None
+        for _ in range(MAX_RENAME_RETRIES):
+            with open(filepath, 'rb') as ifile:
+                before = _stat_signature(os.fstat(ifile.fileno()))
+                if before[1] == 0:
+                    raise StatsInProgress("{0} is empty".format(self))
+                try:
+                    result = load(ifile)
+                except ValueError:
+                    if self.stat() != before:
+                        raise StatsInProgress(
+                            "{0} changed while it was being read"
+                            .format(self))
+                    raise
+                signature = _stat_signature(os.fstat(ifile.fileno()))
+            if before != signature:
+                raise StatsInProgress("{0} changed while it was being read"
+                                      .format(self))
+            if self.stat() == signature:
+                break
+        return result, signature
+
+    def filename(self):
+        """
+        Get the path to the resource on disk
+
+        Returns None if the resource is an asset that is not a plain file (for
+        example if the package is inside a zip archive).
+
+        """
+        if self.path.startswith('/'):
+            return self.path
+        package, filename = self.path.split(':')
+        module = importlib.import_module(package)
+        module_file = getattr(module, '__file__', None)
+        if module_file is None:
+            return None
+        filepath = os.path.join(os.path.dirname(module_file),
+                                *filename.split('/'))
+        if not os.path.isfile(filepath):
+            return None
+        return filepath
+
+    def stat(self):
+        """
+        Get a signature that changes whenever the resource is rewritten
+
+        Returns a tuple of (mtime, size, inode), or None if the resource can't
+        be checked for changes.
+
+        """
+        filepath = self.filename()
+        if filepath is None:
+            return None
+        try:
+            return _stat_signature(os.stat(filepath))
+        except OSError:
+            return None
 
     def __str__(self):
         return "Resource('{0}')".format(self.path)
 
 
+def _immutable(self, *args, **kwargs):
+    """ Raise an error for methods that would modify a Chunk """
+    raise TypeError("Chunks are immutable")
+
+
+class Chunk(dict):
+
+    """
+    Immutable dict for a single chunk in a webpack bundle
+
+    Values can be accessed as items (``chunk['url']``) or as attributes
+    (``chunk.url``). The string values of the common keys are interned. Since
+    chunks are dicts, bundles can be passed to ``json.dumps`` or jinja2's
+    ``tojson``.
+
+    """
+
+    __slots__ = ()
+
+    def __init__(self, data):
+        super(Chunk, self).__init__(
+            # Chunk names and paths repeat across bundles and configs
+            (key, intern(value) if key in CHUNK_FIELDS and
+             isinstance(value, str) else value)
+            for key, value in six.iteritems(data))
+
+    def with_url(self, url):
+        """ Create a copy of this chunk with a 'url' """
+        data = dict(self)
+        data['url'] = url
+        return Chunk(data)
+
+    def __getattr__(self, key):
+        if key.startswith('_'):
+            raise AttributeError(key)
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Chunks are immutable")
+
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return (Chunk, (dict(self),))
+
+    def __repr__(self):
+        return "Chunk({0!r})".format(dict(self))
+
+
+class StatsSnapshot(object):
+
+    """
+    Immutable, pre-indexed copy of a loaded webpack stats file
+
+    Only the :data:`STATS_KEYS` and the chunks are kept, so the rest of the
+    parsed stats file can be released. Each chunk is stored once as a
+    :class:`Chunk` that is shared by every bundle (and, through
+    :meth:`filtered`, every config) that contains it.
+
+    The index maps ``(bundle_name, extensions)`` to a tuple of the chunks that
+    pass the ignore filters. Unfiltered bundles are indexed when the snapshot
+    is created; extension-filtered entries are added the first time they are
+    requested. Reloading the stats creates a new snapshot, which is swapped in
+    with a single reference assignment.
+
+    """
+
+    __slots__ = ('meta', 'signature', 'status', '_bundles', '_index',
+                 '_resolved', '_urls', '_build_id', '_chunk_names', '_stats')
+
+    def __init__(self, stats, signature=None, ignored=None):
+        self.meta = dict((k, stats[k]) for k in STATS_KEYS if k in stats)
+        self.signature = signature
+        self.status = self.meta.get('status')
+        self._bundles = None
+        if stats.get('chunks') is not None:
+            # Chunks that are shared between bundles share one Chunk object
+            shared = {}
+            self._bundles = dict(
+                (bundle_name, tuple(self._make_chunk(c, shared)
+                                    for c in chunks))
+                for bundle_name, chunks in six.iteritems(stats['chunks']))
+        self._build_index(ignored)
+
+    def _build_index(self, ignored):
+        """ Index the bundles, skipping chunks that are ``ignored`` """
+        self._index = {}
+        self._resolved = {}
+        self._urls = {}
+        self._build_id = None
+        self._chunk_names = None
+        self._stats = None
+        if self.status == 'done':
+            for bundle_name, chunks in six.iteritems(self._bundles or {}):
+                self._index[(bundle_name, None)] = tuple(
+                    c for c in chunks
+                    if ignored is None or not ignored(c['name']))
+
+    def _copy(self, bundles, signature, ignored):
+        """ Create a snapshot of the same build with other chunks or filters """
+        snapshot = StatsSnapshot.__new__(StatsSnapshot)
+        snapshot.meta = self.meta
+        snapshot.signature = signature
+        snapshot.status = self.status
+        snapshot._bundles = bundles
+        snapshot._build_index(ignored)  # pylint: disable=W0212
+        return snapshot
+
+    def filtered(self, ignored, signature=None):
+        """
+        Create a copy of this snapshot that uses different ignore filters
+
+        The copy shares this snapshot's chunks.
+
+        """
+        if signature is None:
+            signature = self.signature
+        return self._copy(self._bundles, signature, ignored)
+
+    def with_integrity(self, hashes, ignored=None):
+        """
+        Create a copy with integrity values for the chunks that have none
+
+        ``hashes`` maps chunk names to integrity values.
+
+        """
+        replaced = {}
+
+        def _replace(chunk):
+            """ Get the chunk with its integrity value """
+            if 'integrity' in chunk or chunk['name'] not in hashes:
+                return chunk
+            new = replaced.get(id(chunk))
+            if new is None:
+                new = replaced[id(chunk)] = Chunk(dict(
+                    chunk, integrity=hashes[chunk['name']]))
+            return new
+        bundles = None
+        if self._bundles is not None:
+            bundles = dict(
+                (bundle_name, tuple(_replace(c) for c in chunks))
+                for bundle_name, chunks in six.iteritems(self._bundles))
+        return self._copy(bundles, self.signature, ignored)
+
+    def iter_chunks(self):
+        """ Iterate over every distinct chunk, including ignored ones """
+        seen = set()
+        for chunks in six.itervalues(self._bundles or {}):
+            for chunk in chunks:
+                if id(chunk) not in seen:
+                    seen.add(id(chunk))
+                    yield chunk
+
+    @property
+    def stats(self):
+        """
+        The stats as a dict
+
+        This only has the :data:`STATS_KEYS` and the ``chunks`` (with a
+        ``url`` for chunks that have a ``publicPath``).
+
+        """
+        if self._stats is None:
+            stats = dict(self.meta)
+            if self._bundles is not None:
+                stats['chunks'] = dict(
+                    (bundle_name, list(chunks))
+                    for bundle_name, chunks in six.iteritems(self._bundles))
+            self._stats = stats
+        return self._stats
+
+    @property
+    def build_id(self):
+        """
+        Identifier for the webpack build this snapshot was loaded from
+
+        Uses the ``hash`` from the stats file if present, and otherwise a hash
+        of the bundle chunks.
+
+        """
+        if self._build_id is None:
+            build_id = self.meta.get('hash')
+            if build_id is None:
+                data = json.dumps([self.status, self._bundles],
+                                  sort_keys=True)
+                build_id = hashlib.sha1(data.encode('utf-8')).hexdigest()
+            self._build_id = build_id
+        return self._build_id
+
+    @property
+    def chunk_names(self):
+        """ Set of the names of all chunks in the stats, including ignored """
+        if self._chunk_names is None:
+            self._chunk_names = frozenset(
+                c['name'] for c in self.iter_chunks())
+        return self._chunk_names
+
+    @staticmethod
+    def _make_chunk(data, shared):
+        """
+        Create an immutable Chunk from the stats data
+
+        ``shared`` maps the chunk data to Chunks that were already created, so
+        that identical chunks are only stored once.
+
+        """
+        try:
+            key = tuple(sorted(six.iteritems(data)))
+            chunk = shared.get(key)
+        except TypeError:
+            # Chunks with unhashable values are not shared
+            key = chunk = None
+        if chunk is None:
+            data = dict(data)
+            public_path = data.get('publicPath')
+            if public_path:
+                data['url'] = public_path
+            chunk = Chunk(data)
+            if key is not None:
+                shared[key] = chunk
+        return chunk
+
+    def get_chunks(self, bundle_name, extensions=None):
+        """ Get the filtered chunks for a bundle from the index """
+        if isinstance(extensions, six.string_types):
+            extensions = extensions.split()
+        if extensions is not None:
+            extensions = tuple(extensions)
+        index = self._index
+        key = (bundle_name, extensions)
+        chunks = index.get(key)
+        if chunks is None:
+            unfiltered = index.get((bundle_name, None))
+            if unfiltered is None:
+                raise KeyError('No such bundle {0!r}.'.format(bundle_name))
+            chunks = index[key] = tuple(
+                c for c in unfiltered
+                if any(c['name'].endswith(e) for e in extensions))
+        return chunks
+
+    def get_urls(self, bundle_name, extensions, url_prefix, quote=url_quote):
+        """
+        Get the filtered chunks for a bundle with their 'url' filled in
+
+        Chunk urls are built by joining ``url_prefix`` and the quoted chunk
+        name. The results are cached per prefix.
+
+        """
+        if isinstance(extensions, list):
+            extensions = tuple(extensions)
+        key = (bundle_name, extensions, url_prefix)
+        chunks = self._resolved.get(key)
+        if chunks is None:
+            if len(self._resolved) >= MAX_CACHED_URLS:
+                self._resolved.clear()
+                self._urls.clear()
+            urls = self._urls
+
+            def _with_url(chunk):
+                """ Get the chunk with a url, once per chunk and prefix """
+                if 'url' in chunk:
+                    return chunk
+                url_key = (url_prefix, id(chunk))
+                resolved = urls.get(url_key)
+                if resolved is None:
+                    resolved = urls[url_key] = chunk.with_url(
+                        url_prefix + quote(chunk['name']))
+                return resolved
+            chunks = self._resolved[key] = tuple(
+                _with_url(c) for c in self.get_chunks(bundle_name, extensions))
+        return chunks
+
+
+class StatsRegistry(object):
+
+    """
+    Process-wide cache of parsed stats files
+
+    Each entry is keyed by the resolved path of a stats file (and how it was
+    parsed) and holds an unfiltered :class:`StatsSnapshot` of the most
+    recently loaded version of that file. Configs that point at the same file
+    share its chunks and apply their own filters to them.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def load(self, key, signature, load, reuse=True):
+        """
+        Get the stats for a file, calling ``load()`` if they aren't cached
+
+        Cached stats are only returned if ``reuse`` is True and they were
+        loaded from a file with the same ``signature``. Loads of the same file
+        are serialized, so it is only parsed once even if several configs load
+        it at the same time.
+
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = [threading.Lock(), None, None]
+        with entry[0]:
+            if reuse and signature is not None and entry[1] == signature:
+                return entry[2]
+            stats = load()
+            entry[1] = signature
+            entry[2] = stats
+            return stats
+
+    def clear(self):
+        """ Drop all cached stats """
+        with self._lock:
+            self._entries.clear()
+
+
+STATS_REGISTRY = StatsRegistry()
+
+
 class WebpackState(object):
 
     """ Wrapper for all webpack configuration and cached data """
 
-    def __init__(self, settings, root_package_name=__package__, name='DEFAULT'):
+    def __init__(self, settings, root_package_name=__package__, name='DEFAULT',
+                 metrics=None):
         self.name = name
         self._settings = settings
-        self._stats = None
+        if metrics is None:
+            metrics = load_metrics(settings)
+        self.metrics = metrics
+        self._snapshot = None
+        self._last_good = None
+        self._compile_cond = threading.Condition()
+        self._polling = False
+        self._watcher = None
         self.debug = asbool(self._get_setting('debug', False))
+        self.reload_mode = self._get_setting('reload_mode', 'always')
+        if self.reload_mode not in ('always', 'stat'):
+            raise ValueError("Unknown webpack reload_mode {0!r}"
+                             .format(self.reload_mode))
+        self.serve_stale = asbool(self._get_setting('serve_stale', False))
+        self.watch = asbool(self._get_setting('watch', False))
+        self.preload = asbool(self._get_setting('preload', False))
+        self.watch_interval = float(self._get_setting('watch_interval', 0.5))
+        self.watch_debounce = float(self._get_setting('watch_debounce', 0.1))
         self.static_view = asbool(self._get_setting('static_view', True,
                                                     inherit=False))
         bundle_dir = self._get_setting('bundle_dir', None, inherit=False)
@@ -70,11 +535,32 @@ class WebpackState(object):
         self.static_view_name = self._get_setting('static_view_name',
                                                   'webpack-{0}'.format(name),
                                                   inherit=False)
+        self.content_encodings = aslist(self._get_setting('content_encodings',
+                                                          []))
+        self.inline_bundles = asbool(self._get_setting('inline_bundles',
+                                                       False))
+        self.url_prefix = self._get_setting('url_prefix', None, inherit=False)
+        if self.url_prefix is not None and not self.url_prefix.endswith('/'):
+            self.url_prefix += '/'
+        self._url_prefixes = {}
         stats_file_path = self._get_setting('stats_file', 'webpack-stats.json',
                                             inherit=False)
         self.stats_file = StaticResource.create(stats_file_path,
                                                 root_package_name)
+        self.shared = None
+        shared_path = self._get_setting('shared_stats', None, inherit=False)
+        if shared_path is not None:
+            from .shared import SharedStats
+            self.shared = SharedStats(shared_path)
         self.timeout = float(self._get_setting('timeout', 0))
+        self.read_retries = int(self._get_setting('read_retries', 2))
+        self.read_retry_delay = float(self._get_setting('read_retry_delay', 0))
+        self.stream_stats = asbool(self._get_setting('stream_stats', False))
+        if self.stream_stats:
+            # ijson is slow to import, so only load it if it will be used
+            from . import streaming
+            if streaming.ijson is None:
+                raise ImportError("webpack.stream_stats requires ijson")
         max_age = self._get_setting('cache_max_age', None)
         if max_age is None:
             if not self.debug:
@@ -85,11 +571,53 @@ class WebpackState(object):
         else:
             max_age = float(max_age)
         self.cache_max_age = max_age
+        self.immutable_hashed = asbool(self._get_setting('immutable_hashed',
+                                                         False))
+        self.hashed_re = re.compile(self._get_setting('hashed_re',
+                                                      DEFAULT_HASHED_RE))
+        self.integrity = asbool(self._get_setting('integrity', False))
+        self.integrity_algorithm = self._get_setting('integrity_algorithm',
+                                                     'sha384')
+        self._hashing = None
+        self._hashed = None
+        self.memory_cache_size = int(self._get_setting('memory_cache_size', 0))
+        self.memory_cache_max_file = int(self._get_setting(
+            'memory_cache_max_file', 512 * 1024))
+        self.sendfile = self._get_setting('sendfile', None) or None
+        if self.sendfile not in (None, 'x-sendfile', 'x-accel-redirect'):
+            raise ValueError("Unknown webpack sendfile {0!r}"
+                             .format(self.sendfile))
+        self.sendfile_prefix = self._get_setting('sendfile_prefix', None,
+                                                 inherit=False)
+        if self.sendfile == 'x-accel-redirect':
+            if self.sendfile_prefix is None:
+                raise ValueError("webpack.sendfile = x-accel-redirect requires "
+                                 "webpack.sendfile_prefix")
+            if not self.sendfile_prefix.endswith('/'):
+                self.sendfile_prefix += '/'
+        if self.content_encodings or self.immutable_hashed or \
+                self.memory_cache_size or self.sendfile is not None:
+            from .static import HAS_STATIC_VIEW_API
+            if not HAS_STATIC_VIEW_API:
+                raise ValueError(
+                    "webpack.content_encodings, immutable_hashed, "
+                    "memory_cache_size, and sendfile require Pyramid 2.0 or "
+                    "later")
+        self.preload_links = asbool(self._get_setting('preload_links', False))
         self.ignore = aslist(self._get_setting('ignore',
                                                [r'*.hot-update.js', r'*.map']))
         ignore_re = aslist(self._get_setting('ignore_re', []))
         self.ignore_re = [re.compile(p) for p in ignore_re]
 
+    @reify
+    def _stats_key(self):
+        """ Key for sharing stats with configs that parse the same file """
+        stats_path = self.stats_file.filename()
+        if stats_path is not None:
+            stats_path = os.path.realpath(stats_path)
+        return (stats_path or self.stats_file.path, self.stream_stats,
+                self.shared is not None)
+
     def _get_setting(self, setting, default=None, name=None, inherit=True):
         """ Helper function to fetch settings, inheriting from the base """
         if name is None:
@@ -108,40 +636,466 @@ class WebpackState(object):
                 return val
 
     def load_stats(self, cache=None, wait=None):
-        """ Load and cache the webpack-stats file """
+        """
+        Load and cache the webpack-stats file
+
+        Only the :data:`STATS_KEYS` and ``chunks`` are returned.
+
+        """
+        return self.load_snapshot(cache, wait).stats
+
+    def load_snapshot(self, cache=None, wait=None, info=None):
+        """
+        Load and cache the webpack-stats file as a :class:`StatsSnapshot`
+
+        Takes the same arguments as :meth:`load_stats`. If ``info`` is a dict,
+        it will be updated with ``parsed`` (True if the stats file was read
+        from disk), ``wait`` (seconds spent waiting for a compile), and
+        ``stale`` (True if the last good build was returned because webpack is
+        compiling).
+
+        """
         if cache is None:
             cache = not self.debug
         if wait is None:
             wait = self.debug
-        if not cache or self._stats is None:
-            self._stats = self._load_stats()
-            start = time.time()
-            while wait and self._stats.get('status') == 'compiling':
-                if self.timeout and (time.time() - start > self.timeout):
-                    raise RuntimeError("Webpack {0!r} timed out while compiling"
-                                       .format(self.stats_file.path))
-                time.sleep(0.1)
-                self._stats = self._load_stats()
-        return self._stats
+        if self.watching:
+            # The watcher thread keeps the stats up to date
+            cache = True
+        parsed = False
+        if not cache or self._snapshot is None:
+            parsed = self._reload_stats()
+        if self.metrics is not None:
+            self.metrics.incr('stats_cache.miss' if parsed else
+                              'stats_cache.hit', self.name)
+        if info is not None:
+            info['parsed'] = parsed
+            info['wait'] = 0
+            info['stale'] = False
+        snapshot = self._snapshot
+        if snapshot.status == 'compiling':
+            last_good = self._last_good
+            if self.serve_stale and last_good is not None:
+                if info is not None:
+                    info['stale'] = True
+                return last_good
+            if wait:
+                start = time.time()
+                snapshot = self._wait_for_compile()
+                duration = time.time() - start
+                if self.metrics is not None:
+                    self.metrics.observe('compile_wait.duration', self.name,
+                                         duration)
+                if info is not None:
+                    info['wait'] = duration
+        return snapshot
+
+    def preload_stats(self):
+        """
+        Load the stats file and check that the build is done
+
+        Raises a RuntimeError if the build failed or is still compiling.
+
+        """
+        snapshot = self.load_snapshot(cache=False, wait=False)
+        if snapshot.status == 'error':
+            raise RuntimeError("Webpack {0!r} build failed: {1}: {2}".format(
+                self.name, snapshot.meta.get('error'),
+                snapshot.meta.get('message')))
+        elif snapshot.status != 'done':
+            raise RuntimeError("Webpack {0!r} status is {1!r}, not 'done'"
+                               .format(self.name, snapshot.status))
+        hashing = self._hashing
+        if hashing is not None:
+            hashing.wait()
+            snapshot = self._snapshot
+        return snapshot
+
+    @property
+    def stale(self):
+        """
+        True if webpack is compiling and the previous build is being served
+
+        Only possible when ``serve_stale`` is enabled.
+
+        """
+        snapshot = self._snapshot
+        return self.serve_stale and self._last_good is not None and \
+            snapshot is not None and snapshot.status == 'compiling'
+
+    def _wait_for_compile(self):
+        """
+        Block until webpack is done compiling and return the new snapshot
+
+        Only one waiting thread at a time polls the stats file. The rest sleep
+        on a shared condition and are all woken when the poller sees the status
+        change or gives up.
+
+        """
+        start = time.time()
+        cond = self._compile_cond
+        with cond:
+            while self._snapshot.status == 'compiling':
+                remaining = None
+                if self.timeout:
+                    remaining = self.timeout - (time.time() - start)
+                    if remaining <= 0:
+                        raise RuntimeError(
+                            "Webpack {0!r} timed out while compiling"
+                            .format(self.stats_file.path))
+                if self.watching:
+                    # Wake up now and then in case the watcher has died
+                    if remaining is None or remaining > self.watch_interval:
+                        remaining = self.watch_interval
+                    cond.wait(remaining)
+                    continue
+                if self._polling:
+                    cond.wait(remaining)
+                    continue
+                self._polling = True
+                cond.release()
+                try:
+                    self._poll_compile(start)
+                finally:
+                    cond.acquire()
+                    self._polling = False
+                    cond.notify_all()
+            return self._snapshot
+
+    def _poll_compile(self, start):
+        """ Reload the stats until the status changes or we time out """
+        while self._snapshot.status == 'compiling':
+            if self.timeout and (time.time() - start > self.timeout):
+                return
+            time.sleep(0.1)
+            self._reload_stats()
+
+    def _reload_stats(self):
+        """
+        Reload the stats file into the cache
+
+        If ``reload_mode`` is ``stat`` or ``shared_stats`` is set, the file
+        will only be parsed if its mtime, size, or inode have changed since the
+        last load. Returns True if the file was parsed.
+
+        """
+        signature = self.stats_file.stat()
+        snapshot = self._snapshot
+        by_signature = self.reload_mode == 'stat' or self.shared is not None
+        if by_signature and signature is not None and snapshot is not None \
+                and signature == snapshot.signature:
+            return False
+        try:
+            stats = self._read_stats(signature,
+                                     reuse=by_signature or snapshot is None)
+        except StatsInProgress:
+            if self._snapshot is None:
+                raise
+            # Keep using the current stats until webpack finishes writing
+            return False
+        self._publish(self._make_snapshot(stats, signature))
+        return True
+
+    def _read_stats(self, signature, reuse=True):
+        """
+        Load the stats, sharing them with other configs that use the same file
+
+        If ``reuse`` is True and another config in this process has already
+        loaded this version of the stats file, its stats are returned.
+
+        """
+        return STATS_REGISTRY.load(
+            self._stats_key, signature,
+            lambda: StatsSnapshot(self._read_shared(signature), signature),
+            reuse)
+
+    def _read_shared(self, signature):
+        """
+        Load the stats, going through the ``shared_stats`` file if configured
+
+        If another process already published stats for this version of the
+        stats file, they are loaded from the shared file. Otherwise this
+        process parses the stats file and publishes the result.
+
+        """
+        if self.shared is None or signature is None:
+            return self._load_stats()
+        from . import manifest
+        from .shared import encode_signature
+        source = encode_signature(signature)
+        if self.shared.header()[1] == source:
+            loaded = self.shared.load()
+            if loaded is not None and loaded[0] == source:
+                if self.metrics is not None:
+                    self.metrics.incr('shared_stats.hit', self.name)
+                return loaded[1]
+        with self.shared.lock():
+            # Another process may have published while we waited for the lock
+            loaded = self.shared.load()
+            if loaded is not None and loaded[0] == source:
+                if self.metrics is not None:
+                    self.metrics.incr('shared_stats.hit', self.name)
+                return loaded[1]
+            if self.metrics is not None:
+                self.metrics.incr('shared_stats.miss', self.name)
+            stats = manifest.compile_stats(self._load_stats(), ignore=[])
+            self.shared.publish(stats, signature)
+            return stats
+
+    def _set_stats(self, stats, signature=None):
+        """ Swap in new stats and wake any threads waiting on a compile """
+        self._publish(self._make_snapshot(stats, signature))
+        with self._compile_cond:
+            self._compile_cond.notify_all()
+
+    def _make_snapshot(self, stats, signature=None):
+        """
+        Create a StatsSnapshot using this config's ignore filters
+
+        ``stats`` may be a dict or an unfiltered snapshot from
+        :meth:`_read_stats`.
+
+        """
+        if isinstance(stats, StatsSnapshot):
+            return stats.filtered(self._ignored, signature)
+        return StatsSnapshot(stats, signature, self._ignored)
+
+    def _publish(self, snapshot):
+        """ Make a snapshot the current one """
+        if snapshot.status == 'done':
+            self._last_good = snapshot
+        self._snapshot = snapshot
+        if self.integrity and snapshot.status == 'done':
+            self._hash_chunks(snapshot)
+
+    def _hash_chunks(self, snapshot):
+        """
+        Start hashing the chunks that don't have an 'integrity' value
+
+        When the hashes are done, a copy of the snapshot with the integrity
+        values is swapped in (if the snapshot is still the current one). If
+        the stats file hasn't changed since the last hashed snapshot (e.g. in
+        debug mode, where it is parsed on every request), its hashes are
+        reused right away.
+
+        """
+        hashed = self._hashed
+        if hashed is not None and _same_file(hashed, snapshot):
+            self._add_integrity(snapshot, dict(
+                (c['name'], c['integrity'])
+                for c in hashed.iter_chunks() if 'integrity' in c))
+            return
+        paths = {}
+        for chunk in snapshot.iter_chunks():
+            if 'integrity' not in chunk and not self._ignored(chunk['name']):
+                paths[chunk['name']] = chunk.get('path')
+        if not paths:
+            self._hashed = snapshot
+            return
+        from .integrity import hash_files
+        self._hashing = hash_files(
+            paths, lambda name: self._chunk_file(name, paths[name]),
+            self.integrity_algorithm,
+            lambda hashes: self._add_integrity(snapshot, hashes))
+
+    def _chunk_file(self, name, path=None):
+        """
+        Find the file for a chunk
+
+        Looks in the bundle directory, then at the 'path' from the stats.
+
+        """
+        # add_static_view() resolves relative paths against the package of
+        # the config that calls it, which is this one
+        resource = StaticResource.create(
+            posixpath.join(self.static_view_path, name), __package__)
+        filepath = resource.filename()
+        if filepath is None and path is not None and os.path.isfile(path):
+            filepath = path
+        return filepath
+
+    def _add_integrity(self, snapshot, hashes):
+        """
+        Swap in a copy of a snapshot with chunk integrity values
+
+        The hashes are also used if the current snapshot was loaded from the
+        same version of the stats file.
+
+        """
+        current = self._snapshot
+        if current is not snapshot:
+            if current is None or current.status != 'done' or \
+                    not _same_file(current, snapshot):
+                return
+            snapshot = current
+        hashed = snapshot.with_integrity(hashes, self._ignored)
+        with self._compile_cond:
+            if self._snapshot is snapshot:
+                self._last_good = self._snapshot = self._hashed = hashed
+
+    def start_watching(self):
+        """ Start a background thread that reloads the stats file """
+        if self._watcher is not None:
+            return
+        from .watch import StatsWatcher
+        self._watcher = StatsWatcher(self, self.watch_interval,
+                                     self.watch_debounce)
+        self._watcher.start()
+        atexit.register(self.stop_watching)
+
+    @property
+    def watching(self):
+        """
+        True if a watcher thread is keeping the stats up to date
+
+        If the thread has died, requests go back to reloading the stats.
+
+        """
+        watcher = self._watcher
+        return watcher is not None and watcher.is_alive()
+
+    def stop_watching(self, timeout=None):
+        """ Stop the background watcher thread, if any """
+        watcher, self._watcher = self._watcher, None
+        if watcher is not None:
+            watcher.stop(timeout)
+
+    def get_url_prefix(self, request):
+        """
+        Get the url that chunk names are appended to for a request
+
+        This is either the ``url_prefix`` setting or the url of the static
+        view, which is computed once per application url. Returns None if urls
+        must be generated with ``request.static_url`` for every chunk (for
+        example, if there are cache busters configured).
+
+        """
+        if self.url_prefix is not None:
+            return self.url_prefix
+        app_url = request.application_url
+        prefix = self._url_prefixes.get(app_url)
+        if prefix is None:
+            info = request.registry.queryUtility(IStaticURLInfo)
+            if info is None or getattr(info, 'cache_busters', None):
+                return None
+            try:
+                marker_url = request.static_url(
+                    posixpath.join(self.static_view_path, URL_MARKER))
+            except ValueError:
+                # There is no static view (chunks may all have a publicPath)
+                return None
+            if not marker_url.endswith(URL_MARKER):
+                return None
+            if len(self._url_prefixes) >= MAX_CACHED_URLS:
+                self._url_prefixes.clear()
+            prefix = self._url_prefixes[app_url] = \
+                marker_url[:-len(URL_MARKER)]
+        return prefix
+
+    def get_static_chunks(self, bundle_name, extensions=None):
+        """
+        Get a bundle's chunks if they can be resolved without a request
+
+        This is used to inline bundles into compiled templates. Returns a
+        tuple of (build_id, chunks), or None if the chunk urls depend on the
+        request, the stats may change, or the build is not done.
+
+        """
+        if self.debug or self._watcher is not None:
+            return None
+        snapshot = self.load_snapshot(wait=False)
+        if snapshot.status != 'done':
+            return None
+        if self.integrity and snapshot is not self._hashed:
+            # Wait for the integrity values before inlining
+            return None
+        if self.url_prefix is not None:
+            chunks = snapshot.get_urls(bundle_name, extensions,
+                                       self.url_prefix, self.quote_name)
+        else:
+            chunks = snapshot.get_chunks(bundle_name, extensions)
+            if not all('url' in c for c in chunks):
+                return None
+        return snapshot.build_id, chunks
+
+    def quote_name(self, name):
+        """ Quote a chunk name the same way the static view url would """
+        if urlparse(self.static_view_name).netloc:
+            return url_quote(name)
+        # pyramid.traversal imports pkg_resources, which is slow to import
+        from pyramid.traversal import PATH_SAFE, quote_path_segment
+        return quote_path_segment(name, safe=PATH_SAFE)
+
+    def _ignored(self, name):
+        """ Check if a chunk name matches any of the ignore patterns """
+        for pattern in self.ignore_re:
+            if pattern.match(name):
+                return True
+        for pattern in self.ignore:
+            if fnmatch.fnmatchcase(name, pattern):
+                return True
+        return False
 
     def _load_stats(self):
-        """ Load the webpack-stats file """
-        for attempt in range(0, 3):
+        """
+        Load the webpack-stats file
+
+        If webpack is writing the file concurrently, it is re-read up to
+        ``read_retries`` times (waiting ``read_retry_delay`` seconds between
+        attempts). Raises :class:`StatsInProgress` if it is still being
+        written after that.
+
+        """
+        start = time.time()
+        attempt = 0
+        while True:
             try:
-                with self.stats_file.open() as f:
-                    return json.load(f)
+                (stats, size), _ = self.stats_file.load_stable(
+                    self._parse_stats)
             except ValueError:
-                # If we failed to parse the JSON, it's possible that the
-                # webpack process is writing to it concurrently and it's in a
-                # bad state. Sleep and retry.
-                if attempt < 2:
-                    time.sleep(attempt * 0.2)
-                else:
+                if attempt >= self.read_retries:
                     raise
+                attempt += 1
+                if self.metrics is not None:
+                    self.metrics.incr('load_stats.retries', self.name)
+                if self.read_retry_delay:
+                    time.sleep(self.read_retry_delay)
             except IOError:
                 raise IOError(
                     "Could not read stats file {0}. Make sure you are using the "
                     "webpack-bundle-tracker plugin" .format(self.stats_file))
+            else:
+                if self.metrics is not None:
+                    self.metrics.observe('load_stats.duration', self.name,
+                                         time.time() - start)
+                    self.metrics.observe('load_stats.bytes', self.name, size)
+                return stats
+
+    def _parse_stats(self, ifile):
+        """
+        Parse an open stats file or manifest
+
+        Returns a tuple of (stats, number of bytes read).
+
+        """
+        from . import manifest
+        if manifest.is_manifest(ifile.read(len(manifest.MAGIC))):
+            ifile.seek(0)
+            data = ifile.read()
+            return manifest.loads(data), len(data)
+        ifile.seek(0)
+        if self.stream_stats:
+            from . import streaming
+            stats = streaming.load(ifile)
+            return stats, ifile.tell()
+        data = ifile.read()
+        return json.loads(data.decode('utf-8')), len(data)
+
+
+def _same_file(snapshot, other):
+    """ Check if two snapshots were loaded from the same stats file """
+    return snapshot.signature is not None and \
+        snapshot.signature == other.signature
 
 
 class Webpack(object):
@@ -154,59 +1108,133 @@ class Webpack(object):
         self.state = request.registry.webpack.get(name)
         if self.state is None:
             raise RuntimeError("Unknown webpack config {0!r}".format(name))
+        # Set by the debug toolbar panel to record what the request did
+        self._trace = None
+        self._stale = False
+        trace = getattr(request, '_webpack_trace', None)
+        if isinstance(trace, list):
+            self._trace = {
+                'config': name,
+                'bundles': [],
+            }
+            trace.append(self._trace)
+        # Set by the preload tween to record the chunks the request used
+        self._links = None
+        if self.state.preload_links:
+            self._links = getattr(request, '_webpack_links', None)
 
     @reify
+    def snapshot(self):
+        """ Load and cache the webpack stats snapshot """
+        info = {}
+        if self._trace is None:
+            snapshot = self.state.load_snapshot(info=info)
+        else:
+            start = time.time()
+            snapshot = self.state.load_snapshot(info=info)
+            self._trace.update(info)
+            self._trace['load_duration'] = time.time() - start
+        self._stale = info['stale']
+        return snapshot
+
+    @property
     def stats(self):
-        """ Load and cache the webpack stats file """
-        return self.state.load_stats()
+        """ The webpack stats used by this request """
+        return self.snapshot.stats
 
-    def _chunk_filter(self, extensions):
-        """ Create a filter from the extensions and ignore files """
-        if isinstance(extensions, six.string_types):
-            extensions = extensions.split()
+    @property
+    def stale(self):
+        """
+        True if the stats used by this request are out of date
+
+        This happens with ``webpack.serve_stale`` while webpack is compiling.
 
-        def _filter(chunk):
-            """ Exclusion filter """
-            name = chunk['name']
-            if extensions is not None:
-                if not any(name.endswith(e) for e in extensions):
-                    return False
-            for pattern in self.state.ignore_re:
-                if pattern.match(name):
-                    return False
-            for pattern in self.state.ignore:
-                if fnmatch.fnmatchcase(name, pattern):
-                    return False
-            return True
-        return _filter
+        """
+        self.snapshot  # pylint: disable=W0104
+        return self._stale
+
+    @reify
+    def url_prefix(self):
+        """ The url prefix for chunks in this request (see WebpackState) """
+        return self.state.get_url_prefix(self._request)
 
     def _add_url(self, chunk):
-        """ Add a 'url' property to a chunk and return it """
+        """ Get a copy of a chunk with a 'url' property """
         if 'url' in chunk:
             return chunk
-        public_path = chunk.get('publicPath')
-        if public_path:
-            chunk['url'] = public_path
-        else:
-            fullpath = posixpath.join(self.state.static_view_path,
-                                      chunk['name'])
-            chunk['url'] = self._request.static_url(fullpath)
-        return chunk
+        fullpath = posixpath.join(self.state.static_view_path, chunk['name'])
+        return chunk.with_url(self._request.static_url(fullpath))
+
+    def add_preload_links(self, chunks):
+        """
+        Record chunks that the response will use
+
+        With ``webpack.preload_links``, the preload tween sends a ``Link``
+        header for each of them. ``get_bundle()`` calls this for you.
+
+        """
+        if self._links is not None:
+            build_id = self.snapshot.build_id
+            self._links.extend((self.name, build_id, c['url']) for c in chunks)
 
     def get_bundle(self, bundle_name, extensions=None):
         """ Get all the chunks contained in a bundle """
-        if self.stats.get('status') == 'done':
-            bundle = self.stats.get('chunks', {}).get(bundle_name, None)
-            if bundle is None:
-                raise KeyError('No such bundle {0!r}.'.format(bundle_name))
-            test = self._chunk_filter(extensions)
-            return [self._add_url(c) for c in bundle if test(c)]
-        elif self.stats.get('status') == 'error':
+        metrics = self.state.metrics
+        if metrics is None and self._trace is None:
+            return self._get_bundle(bundle_name, extensions)
+        start = time.time()
+        chunks = None
+        try:
+            chunks = self._get_bundle(bundle_name, extensions)
+            return chunks
+        finally:
+            self._observe_bundle(bundle_name, extensions, chunks,
+                                 time.time() - start)
+
+    def record_bundle(self, bundle_name, extensions, chunks, duration=0):
+        """
+        Record a bundle that was resolved without calling ``get_bundle()``
+
+        This is used when rendered output is cached, so that the metrics,
+        debug toolbar, and preload links still include the bundle.
+
+        """
+        self._observe_bundle(bundle_name, extensions, chunks, duration)
+        self.add_preload_links(chunks)
+
+    def _observe_bundle(self, bundle_name, extensions, chunks, duration):
+        """ Report a bundle lookup to the metrics and debug toolbar """
+        metrics = self.state.metrics
+        if metrics is not None:
+            metrics.observe('get_bundle.duration', self.name, duration)
+        if self._trace is not None:
+            self._trace['bundles'].append({
+                'name': bundle_name,
+                'extensions': extensions,
+                'chunks': None if chunks is None else len(chunks),
+                'duration': duration,
+            })
+
+    def _get_bundle(self, bundle_name, extensions):
+        """ Implementation of get_bundle() """
+        snapshot = self.snapshot
+        if snapshot.status == 'done':
+            prefix = self.url_prefix
+            if prefix is None:
+                chunks = [self._add_url(c) for c in
+                          snapshot.get_chunks(bundle_name, extensions)]
+            else:
+                chunks = list(snapshot.get_urls(bundle_name, extensions,
+                                                prefix, self.state.quote_name))
+            if self._links is not None:
+                self.add_preload_links(chunks)
+            return chunks
+        elif snapshot.status == 'error':
             raise RuntimeError("{error}: {message}".format(**self.stats))
         else:
             raise RuntimeError(
                 "Bad webpack stats file {0} status: {1!r}"
-                .format(self.state.stats_file, self.stats.get('status')))
+                .format(self.state.stats_file, snapshot.status))
 
 
 def get_webpack(request, name='DEFAULT'):
@@ -223,22 +1251,71 @@ def get_webpack(request, name='DEFAULT'):
     return wp
 
 
+def preload_states(states):
+    """
+    Load and validate the stats for several configs in parallel
+
+    Raises a RuntimeError that lists every config that failed.
+
+    """
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(len(states), MAX_PRELOAD_THREADS))
+    errors = []
+    try:
+        results = [pool.apply_async(state.preload_stats) for state in states]
+        for state, result in zip(states, results):
+            try:
+                result.get()
+            except (IOError, ValueError, RuntimeError) as e:
+                errors.append("{0}: {1}".format(state.name, e))
+    finally:
+        pool.close()
+        pool.join()
+    if errors:
+        raise RuntimeError("Failed to preload webpack stats:\n" +
+                           '\n'.join(errors))
+
+
 def includeme(config):
     """ Add pyramid_webpack methods and config to the app """
     settings = config.registry.settings
     root_package_name = config.root_package.__name__
+    metrics = config.registry.webpack_metrics = load_metrics(settings)
     config.registry.webpack = {
-        'DEFAULT': WebpackState(settings, root_package_name)
+        'DEFAULT': WebpackState(settings, root_package_name, metrics=metrics)
     }
     for extra_config in aslist(settings.get('webpack.configs', [])):
-        state = WebpackState(settings, root_package_name, name=extra_config)
+        state = WebpackState(settings, root_package_name, name=extra_config,
+                             metrics=metrics)
         config.registry.webpack[extra_config] = state
 
     # Set up any static views
     for state in six.itervalues(config.registry.webpack):
         if state.static_view:
+            kwargs = {}
+            if state.content_encodings:
+                kwargs['content_encodings'] = state.content_encodings
             config.add_static_view(name=state.static_view_name,
                                    path=state.static_view_path,
-                                   cache_max_age=state.cache_max_age)
+                                   cache_max_age=state.cache_max_age,
+                                   **kwargs)
+            if state.immutable_hashed or state.memory_cache_size or \
+                    state.sendfile is not None:
+                from .static import add_webpack_static_view
+                add_webpack_static_view(config, state)
+
+    if any(state.preload_links
+           for state in six.itervalues(config.registry.webpack)):
+        from .preload import add_preload_tween
+        add_preload_tween(config)
+
+    preload = [state for state in six.itervalues(config.registry.webpack)
+               if state.preload]
+    if preload:
+        preload_states(preload)
+
+    for state in six.itervalues(config.registry.webpack):
+        if state.watch:
+            state.start_watching()
 
     config.add_request_method(get_webpack, 'webpack')
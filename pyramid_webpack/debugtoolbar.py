@@ -0,0 +1,59 @@
+"""
+Panel for pyramid_debugtoolbar
+
+Enable it by adding this module to the ``debugtoolbar.includes`` setting::
+
+    debugtoolbar.includes = pyramid_webpack.debugtoolbar
+
+"""
+from pyramid_debugtoolbar.panels import DebugPanel  # pylint: disable=E0401
+
+
+class WebpackDebugPanel(DebugPanel):
+
+    """
+    Shows the webpack configs and bundles used by a request
+
+    For each config it shows whether the stats came from the cache or were
+    read from disk, how long the request waited on a compiling build, and how
+    long each ``get_bundle()`` call took.
+
+    """
+
+    name = 'webpack'
+    template = 'pyramid_webpack:templates/debugtoolbar.dbtmako'
+    title = 'Webpack'
+    nav_title = 'Webpack'
+
+    def __init__(self, request):
+        self.trace = request._webpack_trace = []  # pylint: disable=W0212
+
+    @property
+    def has_content(self):
+        return bool(self.trace)
+
+    @property
+    def total_duration(self):
+        """ Total seconds spent loading stats and resolving bundles """
+        total = 0
+        for config in self.trace:
+            total += config.get('load_duration', 0)
+            total += sum(b['duration'] for b in config['bundles'])
+        return total
+
+    @property
+    def nav_subtitle(self):
+        if not self.trace:
+            return ''
+        return '{0:.2f}ms'.format(1000 * self.total_duration)
+
+    def process_response(self, response):
+        self.data = {
+            'configs': self.trace,
+            'total_duration': self.total_duration,
+        }
+
+
+def includeme(config):
+    """ Add the webpack panel to the debug toolbar """
+    config.add_debugtoolbar_panel(WebpackDebugPanel)
@@ -0,0 +1,98 @@
+"""
+Subresource Integrity hashes for bundle chunks
+
+When ``webpack.integrity`` is enabled, chunks that don't have an
+``integrity`` value in the stats file are hashed on a background thread pool
+after the stats are loaded. Hashes are cached by file path, mtime, and size, so
+unchanged files are only hashed once per process.
+
+"""
+import base64
+import hashlib
+import logging
+import os
+import threading
+
+
+LOG = logging.getLogger(__name__)
+
+# Number of threads used to hash chunk files
+POOL_SIZE = 4
+
+# Maximum number of file hashes to cache
+MAX_CACHED_HASHES = 10000
+
+_lock = threading.Lock()
+_pool = None
+_cache = {}
+
+
+def get_pool():
+    """ Get the thread pool used for hashing, creating it if needed """
+    global _pool  # pylint: disable=W0603
+    with _lock:
+        if _pool is None:
+            from multiprocessing.pool import ThreadPool
+            _pool = ThreadPool(POOL_SIZE)
+        return _pool
+
+
+def hash_file(path, algorithm='sha384'):
+    """
+    Get the integrity value (e.g. ``sha384-...``) for a file
+
+    Raises OSError if the file can't be read.
+
+    """
+    st = os.stat(path)
+    key = (path, getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size,
+           algorithm)
+    integrity = _cache.get(key)
+    if integrity is None:
+        digest = hashlib.new(algorithm)
+        with open(path, 'rb') as ifile:
+            for block in iter(lambda: ifile.read(64 * 1024), b''):
+                digest.update(block)
+        integrity = '{0}-{1}'.format(
+            algorithm, base64.b64encode(digest.digest()).decode('ascii'))
+        if len(_cache) >= MAX_CACHED_HASHES:
+            _cache.clear()
+        _cache[key] = integrity
+    return integrity
+
+
+def _hash_item(item):
+    """ Hash a (name, path, algorithm) tuple for :func:`hash_files` """
+    name, locate, algorithm = item
+    try:
+        path = locate(name)
+        if path is None:
+            return name, None
+        return name, hash_file(path, algorithm)
+    except (IOError, OSError, ImportError, ValueError):
+        return name, None
+    except Exception:  # pylint: disable=W0703
+        # An exception would fail the hashes for every chunk
+        LOG.exception("Error hashing webpack chunk %s", name)
+        return name, None
+
+
+def hash_files(names, locate, algorithm, callback):
+    """
+    Hash the files for several chunks on the background thread pool
+
+    ``locate`` is called on the pool with each chunk name and returns the path
+    to its file (or None). When they are all hashed, ``callback`` is called
+    with a dict of chunk names to integrity values. Files that can't be found
+    or read are skipped. Returns the AsyncResult.
+
+    """
+    def done(results):
+        """ Pass the hashes to the callback """
+        try:
+            callback(dict(r for r in results if r[1] is not None))
+        except Exception:  # pylint: disable=W0703
+            # Exceptions would kill the pool's result thread
+            LOG.exception("Error adding webpack chunk integrity")
+    items = [(name, locate, algorithm) for name in names]
+    return get_pool().map_async(_hash_item, items, callback=done)
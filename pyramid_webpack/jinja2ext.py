@@ -1,13 +1,31 @@
 """ Jinja2 extension for pyramid_webpack """
 from __future__ import unicode_literals
 
+import binascii
+import copy
+import os
+import time
+
 import six
-from pyramid.threadlocal import get_current_request
+from pyramid.threadlocal import get_current_registry, get_current_request
 
 from jinja2 import nodes
 from jinja2.ext import Extension
 
 
+# Maximum number of rendered webpack blocks to cache per environment
+MAX_CACHED_RENDERS = 1000
+
+# Nodes that make the output of a webpack block depend on more than ASSET.
+# Filters and tests may use the context (e.g. a CSP nonce) or the locale.
+IMPURE_NODES = tuple(
+    getattr(nodes, name) for name in (
+        'Call', 'ContextReference', 'DerivedContextReference',
+        'ExtensionAttribute', 'Filter', 'ImportedName', 'InternalName',
+        'Test',
+    ) if hasattr(nodes, name))
+
+
 class WebpackExtension(Extension):
 
     """
@@ -31,6 +49,11 @@ class WebpackExtension(Extension):
 
     tags = set(['webpack'])
 
+    def __init__(self, environment):
+        super(WebpackExtension, self).__init__(environment)
+        self._render_cache = {}
+        self._cleared_build = None
+
     def parse(self, parser):
         # the first token is the token that started the tag.  In our case
         # we only listen to ``'webpack'`` so this will be a name token with
@@ -52,20 +75,125 @@ class WebpackExtension(Extension):
         # drop the needle (which would always be `endwebpack` in that case)
         body = parser.parse_statements(['name:endwebpack'], drop_needle=True)
 
-        call_args = [nodes.Name('ASSET', 'param')]
+        # If the body only depends on ASSET, the rendered output can be cached
+        # for each stats snapshot. Each compiled block gets a random id, so
+        # blocks on the same line or from an edited template don't collide.
+        if parser.name is not None and _is_pure(body):
+            block_id = binascii.hexlify(os.urandom(8)).decode('ascii')
+            args.append(nodes.Const(block_id))
+        else:
+            args.append(nodes.Const(None))
 
-        return nodes.CallBlock(self.call_method('_get_graph', args), call_args,
-                               [], body).set_lineno(lineno)
+        call_args = [nodes.Name('ASSET', 'param')]
 
-    def _get_graph(self, ctx, bundle, extensions, caller=None):
+        call_block = nodes.CallBlock(self.call_method('_get_graph', args),
+                                     call_args, [], body).set_lineno(lineno)
+        return self._inline(args[1], args[2], body, call_block) or call_block
+
+    def _inline(self, bundle_node, extensions_node, body, fallback):
+        """
+        Resolve a bundle at compile time, if the config allows it
+
+        Returns a node that loops over the bundle chunks as constants, guarded
+        by a check that the webpack build hasn't changed since compilation. If
+        the build has changed, the ``fallback`` node is rendered instead.
+
+        """
+        if not isinstance(bundle_node, nodes.Const) or \
+                not isinstance(bundle_node.value, six.string_types) or \
+                not isinstance(extensions_node, nodes.Const):
+            return None
+        config_name, bundle = _split_bundle(bundle_node.value)
+        webpack = getattr(get_current_registry(), 'webpack', None)
+        state = webpack.get(config_name) if webpack else None
+        if state is None or not state.inline_bundles:
+            return None
+        try:
+            resolved = state.get_static_chunks(bundle, extensions_node.value)
+        except (IOError, ValueError, KeyError, RuntimeError):
+            return None
+        if resolved is None:
+            return None
+        build_id, chunks = resolved
+        chunks = tuple(dict(c) for c in chunks)
+        # Copy the body so the fallback can keep its own nodes
+        body = copy.deepcopy(body, {id(self.environment): self.environment})
+        loop = nodes.For(nodes.Name('ASSET', 'store'),
+                         nodes.Const(chunks),
+                         body, [], None, False).set_lineno(fallback.lineno)
+        test_args = [nodes.Const(config_name), nodes.Const(build_id)]
+        if state.preload_links:
+            test_args.append(nodes.Const(chunks))
+        test = self.call_method('_is_current', test_args)
+        if 'elif_' in nodes.If.fields:
+            return nodes.If(test, [loop], [], [fallback]) \
+                .set_lineno(fallback.lineno)
+        return nodes.If(test, [loop], [fallback]).set_lineno(fallback.lineno)
+
+    def _is_current(self, config_name, build_id, chunks=None):
+        """ Check if an inlined bundle is from the current webpack build """
+        state = get_current_registry().webpack[config_name]
+        current = state.load_snapshot().build_id
+        if current == build_id:
+            if chunks is not None:
+                request = get_current_request()
+                if getattr(request, '_webpack_links', None) is not None:
+                    request.webpack(config_name).add_preload_links(chunks)
+            return True
+        # Recompile templates so they inline the new build. Bytecode caches
+        # would keep loading the old code, so don't bother with those.
+        if self._cleared_build != current and \
+                self.environment.bytecode_cache is None and \
+                self.environment.cache is not None:
+            self._cleared_build = current
+            self.environment.cache.clear()
+        return False
+
+    def _get_graph(self, ctx, bundle, extensions, block_id=None, caller=None):
         """ Run a graph and render the tag contents for each output """
         request = ctx.get('request')
         if request is None:
             request = get_current_request()
-        if ':' in bundle:
-            config_name, bundle = bundle.split(':')
-        else:
-            config_name = 'DEFAULT'
+        config_name, bundle = _split_bundle(bundle)
         webpack = request.webpack(config_name)
-        assets = (caller(a) for a in webpack.get_bundle(bundle, extensions))
-        return ''.join(assets)
+        if isinstance(extensions, list):
+            extensions = tuple(extensions)
+        if block_id is None or webpack.url_prefix is None:
+            assets = (caller(a) for a in webpack.get_bundle(bundle, extensions))
+            return ''.join(assets)
+
+        key = (config_name, bundle, extensions, block_id, webpack.url_prefix)
+        start = time.time()
+        snapshot = webpack.snapshot
+        cached = self._render_cache.get(key)
+        metrics = webpack.state.metrics
+        if cached is not None and cached[0] is snapshot:
+            if metrics is not None:
+                metrics.incr('render_cache.hit', config_name)
+            webpack.record_bundle(bundle, extensions, cached[2],
+                                  time.time() - start)
+            return cached[1]
+        if metrics is not None:
+            metrics.incr('render_cache.miss', config_name)
+        chunks = webpack.get_bundle(bundle, extensions)
+        html = ''.join(caller(a) for a in chunks)
+        if len(self._render_cache) >= MAX_CACHED_RENDERS:
+            self._render_cache.clear()
+        self._render_cache[key] = (snapshot, html, tuple(chunks))
+        return html
+
+
+def _split_bundle(bundle):
+    """ Split a 'config:bundle' string into the config and bundle names """
+    if ':' in bundle:
+        return bundle.split(':')
+    return 'DEFAULT', bundle
+
+
+def _is_pure(body):
+    """ Check if a template body only depends on the ASSET variable """
+    for node in body:
+        for child in node.find_all((nodes.Name,) + IMPURE_NODES):
+            if not isinstance(child, nodes.Name) or child.name != 'ASSET':
+                return False
+    return True
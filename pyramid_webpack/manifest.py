@@ -0,0 +1,116 @@
+"""
+Precompiled webpack stats manifests
+
+The ``pyramid-webpack-compile`` command reads a ``webpack-stats.json`` file and
+writes a compact manifest containing only the data that ``get_bundle()``
+needs. Point ``webpack.stats_file`` at the manifest to load it instead of the
+full stats file.
+
+"""
+from __future__ import print_function
+
+import fnmatch
+import io
+import json
+import pickle
+import re
+import sys
+
+import six
+
+
+# Header that identifies a manifest file
+MAGIC = b'PYRAMID-WEBPACK-MANIFEST:1\n'
+
+from . import STATS_KEYS
+
+# Chunk keys that are kept in the manifest
+CHUNK_KEYS = ('name', 'path', 'publicPath', 'integrity')
+
+DEFAULT_IGNORE = ['*.hot-update.js', '*.map']
+
+
+class _SafeUnpickler(pickle.Unpickler):
+
+    """ Unpickler that refuses to load anything but plain data """
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(
+            "Webpack manifests may not contain {0}.{1}".format(module, name))
+
+
+def is_manifest(data):
+    """ Check if some file data is a manifest """
+    return data.startswith(MAGIC)
+
+
+def compile_stats(stats, ignore=None, ignore_re=None):
+    """
+    Reduce a stats dict to the data needed by ``get_bundle()``
+
+    Chunks that match the ``ignore`` globs or ``ignore_re`` regular
+    expressions are dropped.
+
+    """
+    if ignore is None:
+        ignore = DEFAULT_IGNORE
+    ignore_re = [re.compile(p) for p in ignore_re or ()]
+
+    def _ignored(name):
+        """ Check if a chunk name matches any of the ignore patterns """
+        return any(p.match(name) for p in ignore_re) or \
+            any(fnmatch.fnmatchcase(name, p) for p in ignore)
+
+    manifest = dict((k, stats[k]) for k in STATS_KEYS if k in stats)
+    if 'chunks' in stats:
+        manifest['chunks'] = dict(
+            (bundle_name, [
+                dict((k, c[k]) for k in CHUNK_KEYS if k in c)
+                for c in chunks if not _ignored(c['name'])
+            ]) for bundle_name, chunks in six.iteritems(stats['chunks']))
+    return manifest
+
+
+def dumps(manifest):
+    """ Serialize a compiled manifest to bytes """
+    return MAGIC + pickle.dumps(manifest, 2)
+
+
+def loads(data):
+    """ Load a manifest from the bytes written by :func:`dumps` """
+    if not is_manifest(data):
+        raise ValueError("Data is not a webpack manifest")
+    try:
+        return _SafeUnpickler(io.BytesIO(data[len(MAGIC):])).load()
+    except (pickle.UnpicklingError, EOFError) as e:
+        raise ValueError("Invalid webpack manifest: {0}".format(e))
+
+
+def main(argv=None):
+    """ Compile a webpack stats file into a fast-loading manifest """
+    import argparse
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('stats_file', help="Path to the webpack-stats.json")
+    parser.add_argument('output', help="Path to write the manifest to")
+    parser.add_argument('--ignore', action='append',
+                        help="Drop chunks that match this glob (may be "
+                        "repeated, default: {0})".format(
+                            ', '.join(DEFAULT_IGNORE)))
+    parser.add_argument('--ignore-re', action='append',
+                        help="Drop chunks that match this regular expression "
+                        "(may be repeated)")
+    parser.add_argument('--allow-incomplete', action='store_true',
+                        help="Write the manifest even if the build status is "
+                        "not 'done'")
+    args = parser.parse_args(argv)
+
+    with io.open(args.stats_file, 'r', encoding='utf-8') as ifile:
+        stats = json.load(ifile)
+    if stats.get('status') != 'done' and not args.allow_incomplete:
+        print("Webpack stats status is {0!r}, not 'done'"
+              .format(stats.get('status')), file=sys.stderr)
+        return 1
+    manifest = compile_stats(stats, args.ignore, args.ignore_re)
+    with open(args.output, 'wb') as ofile:
+        ofile.write(dumps(manifest))
+    return 0
@@ -0,0 +1,102 @@
+""" Instrumentation hooks for pyramid_webpack """
+import threading
+from collections import defaultdict
+
+from pyramid.settings import falsey, truthy
+
+
+class Metrics(object):
+
+    """
+    Interface for collecting pyramid_webpack metrics
+
+    Subclass this and set ``webpack.metrics`` to the dotted name of your class
+    to send metrics to your own system. All metrics are labeled with the name
+    of the webpack config.
+
+    Counters (passed to :meth:`incr`):
+
+    * ``load_stats.retries`` - retries after failing to parse the stats file
+    * ``stats_cache.hit`` / ``stats_cache.miss`` - whether a request used the
+      cached stats or re-read the stats file
+    * ``render_cache.hit`` / ``render_cache.miss`` - rendered jinja2 blocks
+    * ``shared_stats.hit`` / ``shared_stats.miss`` - whether stats were loaded
+      from the ``shared_stats`` file or parsed and published by this process
+
+    Observations (passed to :meth:`observe`):
+
+    * ``load_stats.duration`` - seconds spent reading and parsing stats
+    * ``load_stats.bytes`` - size of the stats file that was parsed
+    * ``compile_wait.duration`` - seconds a request waited for a compile
+    * ``get_bundle.duration`` - seconds spent in ``get_bundle()``
+
+    """
+
+    def __init__(self, settings=None):
+        self.settings = settings or {}
+
+    def incr(self, name, config, count=1):
+        """ Increment a counter """
+
+    def observe(self, name, config, value):
+        """ Record a single measurement (a duration or size) """
+
+
+class CounterMetrics(Metrics):
+
+    """ Metrics collector that keeps counts and totals in memory """
+
+    def __init__(self, settings=None):
+        super(CounterMetrics, self).__init__(settings)
+        self._lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.observations = {}
+
+    def incr(self, name, config, count=1):
+        with self._lock:
+            self.counters[(name, config)] += count
+
+    def observe(self, name, config, value):
+        with self._lock:
+            stats = self.observations.get((name, config))
+            if stats is None:
+                stats = self.observations[(name, config)] = {
+                    'count': 0,
+                    'total': 0,
+                    'max': value,
+                }
+            stats['count'] += 1
+            stats['total'] += value
+            stats['max'] = max(stats['max'], value)
+
+    def get(self, name, config='DEFAULT'):
+        """ Get the value of a counter """
+        return self.counters.get((name, config), 0)
+
+    def get_observations(self, name, config='DEFAULT'):
+        """ Get the count, total, and max of an observed value """
+        stats = self.observations.get((name, config))
+        if stats is None:
+            return {'count': 0, 'total': 0, 'max': None}
+        return dict(stats)
+
+
+def load_metrics(settings):
+    """
+    Create the metrics collector from the ``webpack.metrics`` setting
+
+    The setting may be a boolean (to use :class:`CounterMetrics`) or the
+    dotted name of a :class:`Metrics` subclass. Returns None if metrics are
+    disabled.
+
+    """
+    setting = settings.get('webpack.metrics')
+    if setting is None or isinstance(setting, bool):
+        return CounterMetrics(settings) if setting else None
+    if str(setting).lower() in falsey:
+        return None
+    if str(setting).lower() in truthy:
+        return CounterMetrics(settings)
+    from pyramid.path import DottedNameResolver
+    factory = DottedNameResolver().maybe_resolve(setting)
+    return factory(settings)
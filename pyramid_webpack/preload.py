@@ -0,0 +1,116 @@
+"""
+Preload ``Link`` headers for webpack bundles
+
+With ``webpack.preload_links``, a tween records the script and stylesheet
+chunks that a request resolved with ``get_bundle()`` or ``{% webpack %}`` and
+adds a ``Link: <url>; rel=preload; as=script`` header for each one to the
+response.
+
+The links are also remembered for each route. If the WSGI server provides an
+``environ['wsgi.early_hints']`` callable, the remembered links are sent as a
+``103 Early Hints`` response as soon as the route is matched, so the browser
+can start fetching the assets before the view has rendered. Links from an old
+webpack build are never sent.
+
+"""
+import posixpath
+
+from pyramid.events import BeforeTraversal
+from six.moves.urllib.parse import urlparse  # pylint: disable=E0401
+
+
+# The preload ``as`` value for each file extension
+LINK_TYPES = {
+    '.js': 'script',
+    '.mjs': 'script',
+    '.css': 'style',
+}
+
+
+def link_header(url):
+    """ Get the ``Link`` header value that preloads a url, or None """
+    ext = posixpath.splitext(urlparse(url).path)[1]
+    link_type = LINK_TYPES.get(ext.lower())
+    if link_type is None:
+        return None
+    return '<{0}>; rel=preload; as={1}'.format(url, link_type)
+
+
+class PreloadLinks(object):
+
+    """
+    The preload links that each route used the last time it was rendered
+
+    Links are stored as tuples of (config name, build id, header value).
+
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self._routes = {}
+
+    def remember(self, route_name, links):
+        """ Store the links used by a route """
+        self._routes[route_name] = tuple(links)
+
+    def get(self, route_name):
+        """ Get the header values for a route's links from current builds """
+        links = self._routes.get(route_name)
+        if not links:
+            return []
+        webpack = self.registry.webpack
+        build_ids = {}
+        headers = []
+        for config_name, build_id, header in links:
+            if config_name not in build_ids:
+                snapshot = webpack[config_name]._snapshot  # pylint: disable=W0212
+                build_ids[config_name] = \
+                    None if snapshot is None else snapshot.build_id
+            if build_ids[config_name] == build_id:
+                headers.append(header)
+        return headers
+
+
+def preload_tween_factory(handler, registry):
+    """ Tween that adds preload ``Link`` headers for the bundles used """
+    preload = registry.webpack_preload
+
+    def preload_tween(request):
+        """ Record the bundle chunks used by the request """
+        links = request._webpack_links = []  # pylint: disable=W0212
+        response = handler(request)
+        seen = set()
+        unique = []
+        for config_name, build_id, url in links:
+            if url in seen:
+                continue
+            seen.add(url)
+            header = link_header(url)
+            if header is not None:
+                unique.append((config_name, build_id, header))
+        for _, _, header in unique:
+            response.headers.add('Link', header)
+        route = getattr(request, 'matched_route', None)
+        if route is not None and 200 <= response.status_code < 300:
+            preload.remember(route.name, unique)
+        return response
+    return preload_tween
+
+
+def send_early_hints(event):
+    """ Send the links a route used last time as 103 Early Hints """
+    request = event.request
+    early_hints = request.environ.get('wsgi.early_hints')
+    route = getattr(request, 'matched_route', None)
+    if early_hints is None or route is None:
+        return
+    headers = request.registry.webpack_preload.get(route.name)
+    if headers:
+        early_hints([('Link', header) for header in headers])
+
+
+def add_preload_tween(config):
+    """ Add the preload tween and the early hints subscriber """
+    config.registry.webpack_preload = PreloadLinks(config.registry)
+    config.add_tween('pyramid_webpack.preload.preload_tween_factory')
+    config.add_subscriber(send_early_hints, BeforeTraversal)
@@ -0,0 +1,189 @@
+"""
+Webpack stats shared between processes through a memory-mapped file
+
+One process parses the stats file and publishes it as a compact manifest. The
+other processes check a generation counter in the file header and only
+unpickle the manifest when it changes, so the JSON is parsed once per build
+instead of once per worker.
+
+File layout::
+
+    magic (8 bytes)
+    generation (uint64) - odd while a write is in progress
+    payload length (uint64)
+    stats file mtime, size, inode (3 x int64)
+    payload (manifest bytes)
+
+The file only ever grows, so readers never map past its end.
+
+Writers are serialized with ``flock()``. Those locks belong to the open file
+description, which a forked child shares with its parent, so the file is
+reopened whenever the process id changes (e.g. in the workers of a server that
+loads the app before forking).
+
+"""
+import contextlib
+import mmap
+import os
+import struct
+import threading
+
+from . import manifest
+
+
+MAGIC = b'PWSHARE1'
+HEADER = struct.Struct('<8sQQqqq')
+
+
+def encode_signature(signature):
+    """ Convert a StaticResource.stat() signature to integers """
+    if signature is None:
+        return (0, 0, 0)
+    mtime, size, inode = signature
+    if isinstance(mtime, float):
+        mtime = int(mtime * 1e9)
+    return (mtime, size, inode)
+
+
+class SharedStats(object):
+
+    """
+    Memory-mapped file that holds the latest stats for all processes
+
+    Requires ``fcntl`` (i.e. a Unix system) for the writer lock.
+
+    """
+
+    def __init__(self, path):
+        import fcntl  # pylint: disable=W0612
+        self.path = path
+        self._fd = None
+        self._pid = None
+        self._map = None
+        self._open_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def _open(self):
+        """ Open the shared file, creating it if needed """
+        with self._open_lock:
+            return self._open_locked()
+
+    def _open_locked(self):
+        """ Implementation of :meth:`_open` """
+        if self._fd is not None and self._pid != os.getpid():
+            # We were forked, so get a file description (and flock) of our own.
+            # The inherited mapping is still valid.
+            fd, self._fd = self._fd, None
+            os.close(fd)
+        if self._fd is None:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            if os.fstat(fd).st_size < HEADER.size:
+                import fcntl
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    if os.fstat(fd).st_size < HEADER.size:
+                        _pwrite(fd, HEADER.pack(MAGIC, 0, 0, 0, 0, 0), 0)
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+            self._fd = fd
+            self._pid = os.getpid()
+        return self._fd
+
+    def _mapping(self, size):
+        """ Get a read-only mapping of at least ``size`` bytes """
+        if self._map is None or len(self._map) < size:
+            fd = self._open()
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(fd, os.fstat(fd).st_size,
+                                  access=mmap.ACCESS_READ)
+        return self._map
+
+    def close(self):
+        """ Close the mapping and file """
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        with self._open_lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def header(self):
+        """
+        Read the file header
+
+        Returns a tuple of (generation, stats file signature). The generation
+        is 0 if nothing has been published yet.
+
+        """
+        magic, generation, _, mtime, size, inode = \
+            HEADER.unpack_from(self._mapping(HEADER.size), 0)
+        if magic != MAGIC:
+            raise ValueError("{0} is not a shared webpack stats file"
+                             .format(self.path))
+        return generation, (mtime, size, inode)
+
+    def load(self):
+        """
+        Load the published stats
+
+        Returns a tuple of (stats file signature, stats), or None if there is
+        nothing published or a write is in progress.
+
+        """
+        mapping = self._mapping(HEADER.size)
+        _, generation, length, mtime, size, inode = \
+            HEADER.unpack_from(mapping, 0)
+        if generation == 0 or generation % 2:
+            return None
+        mapping = self._mapping(HEADER.size + length)
+        payload = mapping[HEADER.size:HEADER.size + length]
+        if HEADER.unpack_from(mapping, 0)[1] != generation:
+            return None
+        return (mtime, size, inode), manifest.loads(payload)
+
+    @contextlib.contextmanager
+    def lock(self):
+        """ Hold the exclusive writer lock """
+        import fcntl
+        # flock() doesn't exclude other threads that use the same file
+        with self._write_lock:
+            fd = self._open()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def publish(self, stats, signature):
+        """
+        Write new stats to the file. Must be called while holding :meth:`lock`.
+
+        The stats should already be reduced with
+        :func:`~pyramid_webpack.manifest.compile_stats`. Returns the new
+        generation.
+
+        """
+        fd = self._open()
+        payload = manifest.dumps(stats)
+        generation = self.header()[0]
+        # A writer may have died halfway through
+        generation += generation % 2
+        mtime, size, inode = encode_signature(signature)
+        # Mark the write as in progress
+        _pwrite(fd, HEADER.pack(MAGIC, generation + 1, 0, 0, 0, 0), 0)
+        _pwrite(fd, payload, HEADER.size)
+        generation += 2
+        _pwrite(fd, HEADER.pack(MAGIC, generation, len(payload), mtime, size,
+                                inode), 0)
+        return generation
+
+
+def _pwrite(fd, data, offset):
+    """ Write all of some data to a file at an offset """
+    os.lseek(fd, offset, os.SEEK_SET)
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
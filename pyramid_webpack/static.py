@@ -0,0 +1,224 @@
+"""
+Static view for serving webpack bundles
+
+With ``webpack.immutable_hashed``, chunks with a content hash in their name
+(see ``webpack.hashed_re``) are served with a far-future, immutable
+``Cache-Control``. Other files get a strong ``ETag`` built from the webpack
+build hash, and matching ``If-None-Match`` requests are answered with a 304
+without opening the file.
+
+With ``webpack.memory_cache_size``, small files are kept in an in-memory LRU
+cache that is emptied when the build changes. With ``webpack.sendfile``, the
+response only has an ``X-Sendfile`` or ``X-Accel-Redirect`` header and the
+front-end server sends the file.
+
+Requires Pyramid 2.0 or later.
+
+"""
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+
+from pyramid.httpexceptions import HTTPNotFound, HTTPNotModified
+from pyramid.response import FileResponse, Response
+from pyramid.security import NO_PERMISSION_REQUIRED
+from pyramid.settings import asbool
+from pyramid.static import static_view
+from six.moves.urllib.parse import quote as url_quote, urlparse  # pylint: disable=E0401
+
+
+# One year, the longest max-age that caches are expected to honor
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# The static_view API used here (precompressed files, find_best_match) was
+# added in Pyramid 2.0
+HAS_STATIC_VIEW_API = hasattr(static_view, 'find_best_match')
+
+
+class AssetCache(object):
+
+    """
+    Size-capped LRU cache of file contents for a single webpack build
+
+    The cache is emptied whenever it is used with a new build id.
+
+    """
+
+    def __init__(self, max_size, max_file_size):
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.size = 0
+        self._lock = threading.Lock()
+        self._build_id = None
+        self._entries = OrderedDict()
+
+    def get(self, build_id, key):
+        """ Get cached data, or None if it isn't cached """
+        with self._lock:
+            if build_id != self._build_id:
+                self._entries.clear()
+                self.size = 0
+                self._build_id = build_id
+                return None
+            data = self._entries.pop(key, None)
+            if data is not None:
+                # Move it to the most recently used end
+                self._entries[key] = data
+            return data
+
+    def put(self, build_id, key, data):
+        """ Cache some data if it is small enough """
+        if len(data) > min(self.max_file_size, self.max_size):
+            return
+        with self._lock:
+            if build_id != self._build_id:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                _, old = self._entries.popitem(last=False)
+                self.size -= len(old)
+
+
+class WebpackStaticView(static_view):
+
+    """
+    Serves the bundle directory of a webpack config
+
+    Depending on the config, this sets caching headers from the stats
+    (``immutable_hashed``), keeps small files in memory
+    (``memory_cache_size``), or has the front-end server send the files
+    (``sendfile``).
+
+    """
+
+    def __init__(self, state, **kwargs):
+        kwargs.setdefault('cache_max_age', state.cache_max_age)
+        if state.content_encodings:
+            kwargs.setdefault('content_encodings', state.content_encodings)
+        super(WebpackStaticView, self).__init__(
+            state.static_view_path, use_subpath=True, **kwargs)
+        self.state = state
+        self.cache = None
+        if state.memory_cache_size:
+            self.cache = AssetCache(state.memory_cache_size,
+                                    state.memory_cache_max_file)
+
+    def __call__(self, context, request):
+        state = self.state
+        resource_name = self.get_resource_name(request)
+        files = self.get_possible_files(resource_name)
+        if state.sendfile:
+            # The front-end server is responsible for compression
+            files = [f for f in files if f[1] is None]
+        filepath, encoding = self.find_best_match(request, files)
+        if filepath is None:
+            raise HTTPNotFound(request.url)
+
+        snapshot = None
+        if state.immutable_hashed or self.cache is not None:
+            snapshot = self._load_snapshot()
+        immutable = False
+        etag = None
+        if state.immutable_hashed and snapshot is not None and \
+                snapshot.status == 'done':
+            name = '/'.join(request.subpath)
+            build_hash = snapshot.meta.get('hash')
+            if name in snapshot.chunk_names and state.hashed_re.search(name):
+                immutable = True
+            elif build_hash is not None:
+                # Without a build hash we can't tell if unhashed files changed
+                etag = build_hash if encoding is None else \
+                    '{0}-{1}'.format(build_hash, encoding)
+
+        if etag is not None and etag in request.if_none_match:
+            response = HTTPNotModified()
+        else:
+            response = self._make_response(request, resource_name, filepath,
+                                           encoding, snapshot)
+        if immutable:
+            response.cache_expires(IMMUTABLE_MAX_AGE)
+            response.headers['Cache-Control'] = \
+                'public, max-age={0}, immutable'.format(IMMUTABLE_MAX_AGE)
+        elif self.cache_max_age is not None:
+            response.cache_expires(self.cache_max_age)
+        if etag is not None:
+            response.etag = etag
+        if len(files) > 1:
+            response.vary = tuple(response.vary or ()) + ('Accept-Encoding',)
+        return response
+
+    def _load_snapshot(self):
+        """
+        Get the cached stats snapshot, or None if the stats can't be loaded
+
+        Asset requests never reload the stats (even in debug mode), since the
+        page that uses them just did.
+
+        """
+        try:
+            return self.state.load_snapshot(cache=True, wait=False)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _make_response(self, request, resource_name, filepath, encoding,
+                       snapshot):
+        """ Create the response that sends a file """
+        content_type = mimetypes.guess_type(resource_name, strict=False)[0] \
+            or 'application/octet-stream'
+        sendfile = self.state.sendfile
+        if sendfile is not None:
+            response = Response(content_type=content_type)
+            if sendfile == 'x-sendfile':
+                response.headers['X-Sendfile'] = filepath
+            else:
+                response.headers['X-Accel-Redirect'] = url_quote(
+                    self.state.sendfile_prefix + '/'.join(request.subpath))
+            response.content_length = None
+            return response
+        if self.cache is not None and snapshot is not None:
+            st = os.stat(filepath)
+            key = (filepath, st.st_mtime, st.st_size)
+            data = self.cache.get(snapshot.build_id, key)
+            if data is None and st.st_size <= self.cache.max_file_size:
+                with open(filepath, 'rb') as ifile:
+                    data = ifile.read()
+                self.cache.put(snapshot.build_id, key, data)
+            if data is not None:
+                response = Response(body=data, content_type=content_type,
+                                    content_encoding=encoding,
+                                    conditional_response=True)
+                response.last_modified = st.st_mtime
+                return response
+        return FileResponse(filepath, request, None, content_type, encoding)
+
+
+def add_webpack_static_view(config, state):
+    """
+    Serve a config's static view with :class:`WebpackStaticView`
+
+    This must be called after ``config.add_static_view()`` has been called
+    for the config. It registers a GET and HEAD view on the same route, which
+    takes precedence over the default static view.
+
+    """
+    name = state.static_view_name
+    if urlparse(name).netloc:
+        # The files are served by someone else
+        return
+    if not name.endswith('/'):
+        name += '/'
+    if config.route_prefix:
+        route_name = '__{0}/{1}'.format(config.route_prefix, name)
+    else:
+        route_name = '__' + name
+    reload_assets = asbool(config.registry.settings.get(
+        'pyramid.reload_assets', False))
+    config.add_view(WebpackStaticView(state, reload=reload_assets),
+                    route_name=route_name,
+                    request_method=('GET', 'HEAD'),
+                    permission=NO_PERMISSION_REQUIRED)
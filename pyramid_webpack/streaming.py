@@ -0,0 +1,58 @@
+"""
+Streaming parser for large webpack stats files
+
+When ``webpack.stream_stats`` is enabled, the stats file is parsed
+incrementally with `ijson <https://pypi.org/project/ijson/>`_ and only the
+keys that ``get_bundle()`` needs are kept. Everything else (for example the
+``modules`` and ``assets`` data that some webpack-bundle-tracker configurations
+write) is discarded as it is read, so memory use depends on the number of
+chunks instead of the size of the file.
+
+"""
+from .manifest import STATS_KEYS
+
+try:
+    import ijson  # pylint: disable=E0401
+    from ijson.common import ObjectBuilder  # pylint: disable=E0401
+except ImportError:  # pragma: no cover
+    ijson = None
+
+
+# Top-level keys that are kept by the streaming parser
+KEEP_KEYS = STATS_KEYS + ('chunks',)
+
+
+def load(stream, keys=KEEP_KEYS):
+    """
+    Parse the top-level ``keys`` out of a binary stream of JSON
+
+    Raises ValueError if the JSON is invalid.
+
+    """
+    stats = {}
+    key = builder = None
+    depth = 0
+    try:
+        for prefix, event, value in ijson.parse(stream, use_float=True):
+            if builder is not None:
+                builder.event(event, value)
+                if event in ('start_map', 'start_array'):
+                    depth += 1
+                elif event in ('end_map', 'end_array'):
+                    depth -= 1
+                    if depth == 0:
+                        stats[key] = builder.value
+                        key = builder = None
+            elif key is not None:
+                if event in ('start_map', 'start_array'):
+                    builder = ObjectBuilder()
+                    builder.event(event, value)
+                    depth = 1
+                else:
+                    stats[key] = value
+                    key = None
+            elif prefix == '' and event == 'map_key' and value in keys:
+                key = value
+    except ijson.JSONError as e:
+        raise ValueError("Invalid webpack stats: {0}".format(e))
+    return stats
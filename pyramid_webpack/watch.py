@@ -0,0 +1,142 @@
+""" Background watcher that reloads webpack stats files """
+import logging
+import os
+import threading
+import time
+
+from . import StatsInProgress
+
+try:
+    import inotify_simple  # pylint: disable=E0401
+except ImportError:  # pragma: no cover
+    inotify_simple = None
+
+
+LOG = logging.getLogger(__name__)
+
+
+class StatsWatcher(threading.Thread):
+
+    """
+    Daemon thread that reloads a WebpackState's stats file when it changes
+
+    Uses inotify (via the ``inotify_simple`` package) when it is available and
+    falls back to polling ``stat()``. Bursts of writes are debounced, and the
+    stats are parsed on this thread and swapped into the state once they are
+    complete.
+
+    """
+
+    def __init__(self, state, interval=0.5, debounce=0.1, use_inotify=True):
+        super(StatsWatcher, self).__init__(
+            name='webpack-watch-{0}'.format(state.name))
+        self.daemon = True
+        self.state = state
+        self.interval = interval
+        self.debounce = debounce
+        self.use_inotify = use_inotify and inotify_simple is not None
+        self._stop_event = threading.Event()
+        self._basename = None
+
+    def stop(self, timeout=None):
+        """ Stop the watcher thread and wait for it to exit """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    @property
+    def stopped(self):
+        """ True if :meth:`stop` has been called """
+        return self._stop_event.is_set()
+
+    def run(self):
+        last_signature = self._reload(None)
+        inotify = self._create_inotify()
+        try:
+            while not self.stopped:
+                try:
+                    if not self._wait_for_event(inotify):
+                        continue
+                    signature = self._settle()
+                    if signature is None or signature != last_signature:
+                        last_signature = self._reload(signature)
+                except Exception:  # pylint: disable=W0703
+                    # Keep watching, or the stats would never reload again
+                    LOG.exception("Error watching webpack stats %s",
+                                  self.state.stats_file)
+                    self._stop_event.wait(self.interval)
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+    def _create_inotify(self):
+        """ Create an inotify watch on the stats file's directory """
+        filepath = self.state.stats_file.filename()
+        if not self.use_inotify or filepath is None:
+            return None
+        # An asset spec has no filename while the file is being replaced, so
+        # find the name once up front
+        self._basename = os.path.basename(filepath)
+        flags = inotify_simple.flags
+        try:
+            inotify = inotify_simple.INotify()
+        except OSError:
+            LOG.exception("Could not use inotify, polling %s instead",
+                          self.state.stats_file)
+            return None
+        try:
+            # Watch the directory so we notice the file being replaced by a
+            # rename
+            inotify.add_watch(os.path.dirname(filepath),
+                              flags.MODIFY | flags.CLOSE_WRITE |
+                              flags.CREATE | flags.MOVED_TO)
+        except OSError:
+            inotify.close()
+            LOG.exception("Could not use inotify, polling %s instead",
+                          self.state.stats_file)
+            return None
+        return inotify
+
+    def _wait_for_event(self, inotify):
+        """
+        Wait for the stats file to possibly change
+
+        Returns True if the file should be checked. With inotify this waits
+        for an event on the file; otherwise it sleeps for one poll interval.
+
+        """
+        if inotify is None:
+            return not self._stop_event.wait(self.interval)
+        events = inotify.read(timeout=int(self.interval * 1000))
+        return any(event.name == self._basename for event in events)
+
+    def _settle(self):
+        """ Wait until the file has stopped changing for ``debounce`` seconds """
+        signature = self.state.stats_file.stat()
+        while not self._stop_event.wait(self.debounce):
+            new_signature = self.state.stats_file.stat()
+            if new_signature == signature:
+                break
+            signature = new_signature
+        return signature
+
+    def _reload(self, signature):
+        """ Parse the stats file and publish it to the state """
+        if signature is None:
+            signature = self.state.stats_file.stat()
+        start = time.time()
+        try:
+            stats = self.state._read_stats(signature)  # pylint: disable=W0212
+        except StatsInProgress:
+            # The next write to the file will trigger another reload
+            LOG.debug("Webpack stats %s are being written",
+                      self.state.stats_file)
+            return None
+        except Exception:  # pylint: disable=W0703
+            LOG.exception("Error reloading webpack stats %s",
+                          self.state.stats_file)
+            return signature
+        self.state._set_stats(stats, signature)  # pylint: disable=W0212
+        LOG.debug("Reloaded webpack stats %s in %.3fs", self.state.stats_file,
+                  time.time() - start)
+        return signature
@@ -13,6 +13,11 @@ REQUIREMENTS = [
     'six>=1.10.0',
 ]
 
+EXTRAS = {
+    'stream': ['ijson>=3.1'],
+    'watch': ['inotify_simple'],
+}
+
 TEST_REQUIREMENTS = [
     'nose',
     'pyramid_jinja2',
@@ -48,5 +53,11 @@ if __name__ == "__main__":
         include_package_data=True,
         packages=find_packages(exclude=('tests',)),
         install_requires=REQUIREMENTS,
+        extras_require=EXTRAS,
+        entry_points={
+            'console_scripts': [
+                'pyramid-webpack-compile = pyramid_webpack.manifest:main',
+            ],
+        },
         tests_require=REQUIREMENTS + TEST_REQUIREMENTS,
     )
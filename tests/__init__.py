@@ -2,6 +2,7 @@
 import os
 import inspect
 import re
+import time
 
 import json
 import shutil
@@ -13,7 +14,9 @@ from pyramid.renderers import render_to_response
 from six.moves.queue import Queue, Empty  # pylint: disable=E0401
 from threading import Thread
 
-from pyramid_webpack import WebpackState, Webpack, StaticResource
+import pyramid_webpack
+from pyramid_webpack import WebpackState, Webpack, StaticResource, streaming
+from pyramid_webpack.static import HAS_STATIC_VIEW_API
 
 
 try:
@@ -68,7 +71,7 @@ class TestWebpackState(TempDirTest):
 
     def test_load_stats(self):
         """ State loads stats from a json file """
-        data = {'a': 'b'}
+        data = {'hash': 'a'}
         stats_file = self._write('stats.json', data)
         settings = {
             'webpack.stats_file': stats_file,
@@ -89,7 +92,7 @@ class TestWebpackState(TempDirTest):
         }
         state = WebpackState(settings)
         stats = state.load_stats()
-        self.assertEqual(stats, {'a': 'b'})
+        self.assertEqual(stats, {'hash': 'a'})
 
     def test_missing_stats(self):
         """ raise IOError if stats file is missing """
@@ -99,7 +102,7 @@ class TestWebpackState(TempDirTest):
 
     def test_cache_stats(self):
         """ When cache=True, cache the stats file """
-        data = {'a': 'b'}
+        data = {'hash': 'a'}
         stats_file = self._write('stats.json', data)
         settings = {
             'webpack.stats_file': stats_file,
@@ -108,24 +111,68 @@ class TestWebpackState(TempDirTest):
         stats = state.load_stats(cache=True)
         self.assertEqual(data, stats)
         with open(stats_file, 'w') as ofile:
-            json.dump({'b': 'c'}, ofile)
+            json.dump({'hash': 'b'}, ofile)
         second_stats = state.load_stats(cache=True)
         self.assertEqual(second_stats, stats)
 
     def test_no_cache_stats(self):
         """ When cache=False, don't cache the stats file """
-        stats_file = self._write('stats.json', {'a': 'b'})
+        stats_file = self._write('stats.json', {'hash': 'a'})
         settings = {
             'webpack.stats_file': stats_file,
         }
         state = WebpackState(settings)
         state.load_stats(cache=False)
-        data = {'b': 'c'}
+        data = {'hash': 'b'}
         with open(stats_file, 'w') as ofile:
             json.dump(data, ofile)
         stats = state.load_stats(cache=False)
         self.assertEqual(stats, data)
 
+    def test_stat_reload_unchanged(self):
+        """ reload_mode = stat doesn't re-parse an unchanged stats file """
+        stats_file = self._write('stats.json', {'hash': 'a'})
+        settings = {
+            'webpack.stats_file': stats_file,
+            'webpack.reload_mode': 'stat',
+        }
+        state = WebpackState(settings)
+        stats = state.load_stats(cache=False)
+        second_stats = state.load_stats(cache=False)
+        self.assertIs(second_stats, stats)
+
+    def test_stat_reload_changed(self):
+        """ reload_mode = stat re-parses the stats file when it changes """
+        stats_file = self._write('stats.json', {'hash': 'a'})
+        settings = {
+            'webpack.stats_file': stats_file,
+            'webpack.reload_mode': 'stat',
+        }
+        state = WebpackState(settings)
+        state.load_stats(cache=False)
+        data = {'hash': 'cd'}
+        with open(stats_file, 'w') as ofile:
+            json.dump(data, ofile)
+        stats = state.load_stats(cache=False)
+        self.assertEqual(stats, data)
+
+    def test_stat_asset(self):
+        """ Asset resources can be checked for changes """
+        resource = StaticResource('tests:test-stats.json')
+        self.assertIsNotNone(resource.stat())
+
+    def test_static_view_requires_pyramid_2(self):
+        """ Static view settings raise an error before Pyramid 2.0 """
+        from mock import patch
+        with patch('pyramid_webpack.static.HAS_STATIC_VIEW_API', False):
+            with self.assertRaises(ValueError):
+                WebpackState({'webpack.content_encodings': 'gzip'})
+
+    def test_bad_reload_mode(self):
+        """ Unknown reload_mode raises an error """
+        with self.assertRaises(ValueError):
+            WebpackState({'webpack.reload_mode': 'sometimes'})
+
     def test_multiple_configs(self):
         """ Multiple webpack states can have their own configs """
         settings = {
@@ -137,6 +184,40 @@ class TestWebpackState(TempDirTest):
         other_state = WebpackState(settings, name='other')
         self.assertTrue(other_state.stats_file.path.endswith(':bar'))
 
+    def test_preload(self):
+        """ includeme() loads the stats for every config with preload """
+        settings = {
+            'webpack.preload': 'true',
+            'webpack.stats_file': self._write('stats.json',
+                                              {'status': 'done'}),
+            'webpack.other.stats_file': self._write('other.json',
+                                                    {'status': 'done'}),
+            'webpack.configs': ['other'],
+        }
+        config = Configurator(settings=settings)
+        config.include('pyramid_webpack')
+        for state in config.registry.webpack.values():
+            self.assertIsNotNone(state._snapshot)
+
+    def test_preload_not_done(self):
+        """ Preloading fails if any build is not done """
+        settings = {
+            'webpack.preload': 'true',
+            'webpack.stats_file': self._write('stats.json',
+                                              {'status': 'done'}),
+            'webpack.other.stats_file': self._write('other.json',
+                                                    {'status': 'compiling'}),
+            'webpack.third.stats_file': os.path.join(self._tempdir, 'nope'),
+            'webpack.configs': ['other', 'third'],
+        }
+        config = Configurator(settings=settings)
+        with self.assertRaises(RuntimeError) as cm:
+            config.include('pyramid_webpack')
+        message = str(cm.exception)
+        self.assertIn('other', message)
+        self.assertIn('third', message)
+        self.assertNotIn('DEFAULT', message)
+
     def test_no_wait_for_compile(self):
         """ The load_stats() call doesn't block if wait=False """
         data = {'status': 'compiling'}
@@ -167,6 +248,60 @@ class TestWebpackState(TempDirTest):
         data = queue.get(True, 5)
         self.assertEqual(data, stats)
 
+    def test_shared_compile_wait(self):
+        """ Threads waiting for a compile share a single poller """
+        stats_file = self._write('stats.json', {'status': 'compiling'})
+        settings = {
+            'webpack.stats_file': stats_file,
+        }
+        state = WebpackState(settings)
+        load = state._load_stats
+        state._load_stats = MagicMock(side_effect=load)
+        queues = [run_load_stats(state, wait=True) for _ in range(8)]
+        with self.assertRaises(Empty):
+            queues[0].get(True, 0.3)
+        # One thread polls the file on behalf of the others
+        self.assertLess(state._load_stats.call_count, 8)
+
+        stats = {'status': 'done'}
+        with open(stats_file, 'w') as ofile:
+            json.dump(stats, ofile)
+        for queue in queues:
+            self.assertEqual(queue.get(True, 5), stats)
+
+    def test_serve_stale(self):
+        """ With serve_stale, the last good stats are served while compiling """
+        data = {'status': 'done', 'chunks': {}}
+        stats_file = self._write('stats.json', data)
+        settings = {
+            'webpack.stats_file': stats_file,
+            'webpack.serve_stale': 'true',
+        }
+        state = WebpackState(settings)
+        state.load_stats(cache=False)
+        self._write('stats.json', {'status': 'compiling'})
+        stats = state.load_stats(cache=False, wait=True)
+        self.assertEqual(stats, data)
+        self.assertTrue(state.stale)
+
+        new_data = {'status': 'done', 'chunks': {'main': []}}
+        self._write('stats.json', new_data)
+        stats = state.load_stats(cache=False, wait=True)
+        self.assertEqual(stats, new_data)
+        self.assertFalse(state.stale)
+
+    def test_serve_stale_no_good_stats(self):
+        """ With serve_stale, still wait if there are no good stats yet """
+        stats_file = self._write('stats.json', {'status': 'compiling'})
+        settings = {
+            'webpack.stats_file': stats_file,
+            'webpack.serve_stale': 'true',
+            'webpack.timeout': 0.2,
+        }
+        state = WebpackState(settings)
+        with self.assertRaises(RuntimeError):
+            state.load_stats(wait=True)
+
     def test_compile_timeout(self):
         """ The load_stats() call will timeout if compile takes too long """
         stats_file = self._write('stats.json', {'status': 'compiling'})
@@ -190,6 +325,57 @@ class TestWebpackState(TempDirTest):
         with self.assertRaises(ValueError):
             state.load_stats()
 
+    def test_load_in_progress(self):
+        """ load_stats() raises StatsInProgress if the file is being written """
+        from pyramid_webpack import StatsInProgress
+        stats_file = os.path.join(self._tempdir, 'stats.json')
+        open(stats_file, 'w').close()
+        state = WebpackState({'webpack.stats_file': stats_file})
+        with self.assertRaises(StatsInProgress):
+            state.load_stats()
+
+    def test_reload_in_progress(self):
+        """ The current stats are kept while the file is being written """
+        stats_file = self._write('stats.json', {'hash': 'a'})
+        state = WebpackState({'webpack.stats_file': stats_file})
+        state.load_stats()
+        open(stats_file, 'w').close()
+        state._load_stats = MagicMock(wraps=state._load_stats)
+        self.assertEqual(state.load_stats(cache=False), {'hash': 'a'})
+        self.assertTrue(state._load_stats.called)
+
+    def test_read_replaced(self):
+        """ A file replaced by a rename while it is read is read again """
+        stats_file = self._write('stats.json', {'hash': 'a'})
+        resource = StaticResource(stats_file)
+        new_file = self._write('new.json', {'hash': 'b'})
+        real_stat = resource.stat
+
+        def stat():
+            """ Replace the file the first time it is checked """
+            if os.path.exists(new_file):
+                os.rename(new_file, stats_file)
+            return real_stat()
+        resource.stat = stat
+        data, signature = resource.load_stable(lambda f: f.read())
+        self.assertEqual(json.loads(data.decode('utf-8')), {'hash': 'b'})
+        self.assertEqual(signature, real_stat())
+
+    def test_read_retry_settings(self):
+        """ The number of retries and delay between them are configurable """
+        stats_file = self._write('stats.json', {})
+        with open(stats_file, 'a') as ofile:
+            ofile.write('aaaaa')
+        state = WebpackState({
+            'webpack.stats_file': stats_file,
+            'webpack.read_retries': '0',
+        })
+        state.stats_file.load_stable = MagicMock(
+            wraps=state.stats_file.load_stable)
+        with self.assertRaises(ValueError):
+            state.load_stats()
+        self.assertEqual(state.stats_file.load_stable.call_count, 1)
+
     def test_abs_static_view(self):
         """ Absolute bundle directory paths are stored unmodified """
         settings = {
@@ -211,9 +397,18 @@ class TestWebpackState(TempDirTest):
         resource = StaticResource('pyramid_webpack:jinja2ext.py')
         import pyramid_webpack.jinja2ext
         with resource.open() as i:
-            self.assertEqual(i.read(),
+            self.assertEqual(i.read().decode('utf-8'),
                              inspect.getsource(pyramid_webpack.jinja2ext))
 
+    def test_import_no_slow_modules(self):
+        """ Importing pyramid_webpack doesn't import slow optional modules """
+        import subprocess
+        import sys
+        code = ("import sys, pyramid_webpack; "
+                "sys.exit(any(m in sys.modules for m in "
+                "('pkg_resources', 'ijson', 'argparse')))")
+        self.assertEqual(subprocess.call([sys.executable, '-c', code]), 0)
+
     def test_future_expire(self):
         """ cache_max_age = future uses 10 year expiration """
         settings = {
@@ -247,6 +442,484 @@ class TestWebpackState(TempDirTest):
         self.assertEqual(state.cache_max_age, 3600)
 
 
+class TestStatsWatcher(TempDirTest):
+
+    """ Tests for the background stats watcher """
+
+    def _wait_for(self, state, data, timeout=5):
+        """ Wait for the state's cached stats to equal some data """
+        end = time.time() + timeout
+        while time.time() < end:
+            snapshot = state._snapshot
+            if snapshot is not None and snapshot.stats == data:
+                return
+            time.sleep(0.01)
+        self.fail("Timed out waiting for stats {0!r}".format(data))
+
+    def _make_state(self, data, **kwargs):
+        """ Create a watching WebpackState """
+        settings = {
+            'webpack.stats_file': self._write('stats.json', data),
+            'webpack.watch': 'true',
+            'webpack.watch_interval': '0.05',
+            'webpack.watch_debounce': '0.01',
+        }
+        state = WebpackState(settings)
+        self.addCleanup(state.stop_watching)
+        return state
+
+    def test_watch_reload(self):
+        """ The watcher picks up changes to the stats file """
+        state = self._make_state({'hash': 'a'})
+        state.start_watching()
+        self._wait_for(state, {'hash': 'a'})
+        self._write('stats.json', {'hash': 'b'})
+        self._wait_for(state, {'hash': 'b'})
+
+    def test_watch_poll(self):
+        """ The watcher can fall back to polling """
+        from pyramid_webpack.watch import StatsWatcher
+        state = self._make_state({'hash': 'a'})
+        state._watcher = StatsWatcher(state, 0.05, 0.01, use_inotify=False)
+        state._watcher.start()
+        self._wait_for(state, {'hash': 'a'})
+        self._write('stats.json', {'hash': 'b'})
+        self._wait_for(state, {'hash': 'b'})
+
+    def test_watch_no_disk_reads(self):
+        """ load_stats() doesn't read the stats file while watching """
+        state = self._make_state({'hash': 'a'})
+        state.start_watching()
+        self._wait_for(state, {'hash': 'a'})
+        state._load_stats = MagicMock()
+        state.load_stats(cache=False)
+        self.assertFalse(state._load_stats.called)
+
+    def test_watch_wakes_waiters(self):
+        """ Threads waiting on a compile are woken by the watcher """
+        state = self._make_state({'status': 'compiling'})
+        state.start_watching()
+        self._wait_for(state, {'status': 'compiling'})
+        queue = run_load_stats(state, wait=True)
+        with self.assertRaises(Empty):
+            queue.get(True, 0.1)
+        self._write('stats.json', {'status': 'done'})
+        self.assertEqual(queue.get(True, 5), {'status': 'done'})
+
+    def test_watch_survives_errors(self):
+        """ The watcher keeps running after an unexpected error """
+        state = self._make_state({'hash': 'a'})
+        state.start_watching()
+        self._wait_for(state, {'hash': 'a'})
+        read_stats = state._read_stats
+        state._read_stats = MagicMock(side_effect=TypeError('oops'))
+        self._write('stats.json', {'hash': 'b'})
+        end = time.time() + 5
+        while state._read_stats.call_count == 0 and time.time() < end:
+            time.sleep(0.01)
+        state._read_stats = read_stats
+        self._write('stats.json', {'hash': 'c'})
+        self._wait_for(state, {'hash': 'c'})
+        self.assertTrue(state.watching)
+
+    def test_dead_watcher(self):
+        """ Requests reload the stats if the watcher thread has died """
+        from pyramid_webpack.watch import StatsWatcher
+        state = self._make_state({'status': 'compiling'})
+        state._watcher = StatsWatcher(state)
+        self.assertFalse(state.watching)
+        state.load_stats()
+        queue = run_load_stats(state, wait=True)
+        self._write('stats.json', {'status': 'done'})
+        self.assertEqual(queue.get(True, 5), {'status': 'done'})
+
+    def test_stop_watching(self):
+        """ stop_watching() stops the watcher thread """
+        state = self._make_state({'hash': 'a'})
+        state.start_watching()
+        watcher = state._watcher
+        state.stop_watching()
+        self.assertFalse(watcher.is_alive())
+
+
+class TestMetrics(TempDirTest):
+
+    """ Tests for the metrics hooks """
+
+    def test_load_metrics(self):
+        """ webpack.metrics selects the metrics collector """
+        from pyramid_webpack.metrics import CounterMetrics, load_metrics
+        self.assertIsNone(load_metrics({}))
+        self.assertIsNone(load_metrics({'webpack.metrics': 'false'}))
+        self.assertIsInstance(load_metrics({'webpack.metrics': 'true'}),
+                              CounterMetrics)
+        metrics = load_metrics({
+            'webpack.metrics': 'pyramid_webpack.metrics.Metrics',
+        })
+        self.assertEqual(type(metrics).__name__, 'Metrics')
+
+    def test_stats_metrics(self):
+        """ Loading stats records parse time, size, and cache hits """
+        stats_file = self._write('stats.json', {'status': 'done'})
+        state = WebpackState({
+            'webpack.stats_file': stats_file,
+            'webpack.metrics': 'true',
+        })
+        state.load_stats()
+        state.load_stats()
+        metrics = state.metrics
+        self.assertEqual(metrics.get('stats_cache.miss'), 1)
+        self.assertEqual(metrics.get('stats_cache.hit'), 1)
+        self.assertEqual(
+            metrics.get_observations('load_stats.duration')['count'], 1)
+        self.assertEqual(
+            metrics.get_observations('load_stats.bytes')['total'],
+            os.path.getsize(stats_file))
+
+    def test_retry_metrics(self):
+        """ Retries parsing the stats file are counted """
+        stats_file = self._write('stats.json', {})
+        with open(stats_file, 'a') as ofile:
+            ofile.write('aaaaa')
+        state = WebpackState({
+            'webpack.stats_file': stats_file,
+            'webpack.metrics': 'true',
+        })
+        with self.assertRaises(ValueError):
+            state.load_stats()
+        self.assertEqual(state.metrics.get('load_stats.retries'), 2)
+
+    def test_get_bundle_metrics(self):
+        """ get_bundle() latency is recorded """
+        stats_file = self._write('stats.json', {
+            'status': 'done',
+            'chunks': {'main': [{'name': 'main.js'}]},
+        })
+        request = MagicMock()
+        request.registry.webpack = {
+            'DEFAULT': WebpackState({
+                'webpack.stats_file': stats_file,
+                'webpack.metrics': 'true',
+                'webpack.url_prefix': '/static/',
+            }),
+        }
+        webpack = Webpack(request)
+        webpack.get_bundle('main')
+        observed = webpack.state.metrics.get_observations(
+            'get_bundle.duration')
+        self.assertEqual(observed['count'], 1)
+
+
+class TestManifest(TempDirTest):
+
+    """ Tests for the precompiled stats manifest """
+
+    def setUp(self):
+        super(TestManifest, self).setUp()
+        self.stats = {
+            'status': 'done',
+            'chunks': {
+                'main': [
+                    {'name': 'main.js', 'path': '/static/main.js'},
+                    {'name': 'main.js.map', 'path': '/static/main.js.map'},
+                ],
+            },
+            'modules': ['lots', 'of', 'data'],
+        }
+        self.stats_file = self._write('stats.json', self.stats)
+        self.manifest_file = os.path.join(self._tempdir, 'manifest.bin')
+
+    def test_compile(self):
+        """ The compiler only keeps what get_bundle() needs """
+        from pyramid_webpack.manifest import main
+        self.assertEqual(main([self.stats_file, self.manifest_file]), 0)
+        state = WebpackState({'webpack.stats_file': self.manifest_file})
+        stats = state.load_stats()
+        self.assertEqual(stats, {
+            'status': 'done',
+            'chunks': {
+                'main': [{'name': 'main.js', 'path': '/static/main.js'}],
+            },
+        })
+
+    def test_compile_incomplete(self):
+        """ The compiler refuses to compile a build that isn't done """
+        from pyramid_webpack.manifest import main
+        self._write('stats.json', {'status': 'compiling'})
+        self.assertEqual(main([self.stats_file, self.manifest_file]), 1)
+        self.assertFalse(os.path.exists(self.manifest_file))
+
+    def test_load_unsafe(self):
+        """ Manifests can't contain arbitrary objects """
+        import pickle
+        from pyramid_webpack.manifest import MAGIC
+        with open(self.manifest_file, 'wb') as ofile:
+            ofile.write(MAGIC + pickle.dumps(object(), 2))
+        state = WebpackState({'webpack.stats_file': self.manifest_file})
+        with self.assertRaises(ValueError):
+            state.load_stats()
+
+
+@unittest.skipIf(streaming.ijson is None,
+                 "ijson is not installed")
+class TestStreaming(TempDirTest):
+
+    """ Tests for the streaming stats parser """
+
+    def test_load_stats(self):
+        """ Only the keys needed by get_bundle() are kept """
+        stats = {
+            'status': 'done',
+            'hash': 'abc123',
+            'chunks': {
+                'main': [{'name': 'main.js', 'path': '/static/main.js'}],
+            },
+            'modules': [{'chunks': ['main'], 'size': 1.5}],
+        }
+        state = WebpackState({
+            'webpack.stats_file': self._write('stats.json', stats),
+            'webpack.stream_stats': 'true',
+        })
+        del stats['modules']
+        self.assertEqual(state.load_stats(), stats)
+
+    def test_load_bad_data(self):
+        """ Invalid json raises a ValueError """
+        stats_file = self._write('stats.json', {'status': 'done'})
+        with open(stats_file, 'a') as ofile:
+            ofile.write('aaaaa')
+        state = WebpackState({
+            'webpack.stats_file': stats_file,
+            'webpack.stream_stats': 'true',
+        })
+        with self.assertRaises(ValueError):
+            state.load_stats()
+
+
+class TestStatsRegistry(TempDirTest):
+
+    """ Tests for sharing stats between configs in a process """
+
+    def setUp(self):
+        super(TestStatsRegistry, self).setUp()
+        self.stats = {
+            'status': 'done',
+            'chunks': {
+                'main': [
+                    {'name': 'main.js', 'path': '/static/main.js'},
+                    {'name': 'main.css', 'path': '/static/main.css'},
+                ],
+            },
+        }
+        stats_file = self._write('stats.json', self.stats)
+        self.settings = {
+            'webpack.stats_file': stats_file,
+            'webpack.other.stats_file': stats_file,
+            'webpack.other.ignore': '*.css',
+            'webpack.other.reload_mode': 'stat',
+        }
+
+    def test_parse_once(self):
+        """ Configs that use the same file share the parsed stats """
+        state = WebpackState(self.settings)
+        other = WebpackState(self.settings, name='other')
+        state.load_stats()
+        other._load_stats = MagicMock()
+        self.assertIs(other.load_snapshot().get_chunks('main')[0],
+                      state.load_snapshot().get_chunks('main')[0])
+        self.assertFalse(other._load_stats.called)
+        self.assertEqual(len(state.load_snapshot().get_chunks('main')), 2)
+        self.assertEqual(len(other.load_snapshot().get_chunks('main')), 1)
+
+    def test_reload_changed(self):
+        """ A changed file is parsed once for all configs """
+        state = WebpackState(self.settings)
+        other = WebpackState(self.settings, name='other')
+        state.load_stats()
+        other.load_stats()
+        self._write('stats.json', {'status': 'compiling'})
+        self.assertEqual(state.load_stats(cache=False),
+                         {'status': 'compiling'})
+        other._load_stats = MagicMock()
+        self.assertEqual(other.load_stats(cache=False),
+                         {'status': 'compiling'})
+        self.assertFalse(other._load_stats.called)
+
+    def test_always_reparse(self):
+        """ reload_mode = always still parses the file on every load """
+        state = WebpackState(self.settings)
+        state.load_stats()
+        state._load_stats = MagicMock(return_value={'hash': 'a'})
+        self.assertEqual(state.load_stats(cache=False), {'hash': 'a'})
+
+
+class TestSharedStats(TempDirTest):
+
+    """ Tests for sharing stats between processes """
+
+    def setUp(self):
+        super(TestSharedStats, self).setUp()
+        self.stats = {
+            'status': 'done',
+            'chunks': {
+                'main': [{'name': 'main.js', 'path': '/static/main.js'}],
+            },
+        }
+        self.settings = {
+            'webpack.stats_file': self._write('stats.json', self.stats),
+            'webpack.shared_stats': os.path.join(self._tempdir, 'shared.bin'),
+        }
+
+    def _make_state(self):
+        """ Create a WebpackState as if it were in a new process """
+        pyramid_webpack.STATS_REGISTRY.clear()
+        state = WebpackState(self.settings)
+        self.addCleanup(state.shared.close)
+        return state
+
+    def test_load_from_shared(self):
+        """ A second process loads the stats without parsing them """
+        first = self._make_state()
+        self.assertEqual(first.load_stats(), self.stats)
+        second = self._make_state()
+        second._load_stats = MagicMock()
+        self.assertEqual(second.load_stats(), self.stats)
+        self.assertFalse(second._load_stats.called)
+
+    def test_reload_changed(self):
+        """ A new stats file is parsed once and published to the others """
+        first = self._make_state()
+        second = self._make_state()
+        first.load_stats()
+        second.load_stats()
+        stats = {'status': 'compiling', 'chunks': {}}
+        self._write('stats.json', stats)
+        self.assertEqual(first.load_stats(cache=False), stats)
+        second._load_stats = MagicMock()
+        self.assertEqual(second.load_stats(cache=False), stats)
+        self.assertFalse(second._load_stats.called)
+
+    @unittest.skipIf(not hasattr(os, 'fork'), "os.fork is not available")
+    def test_lock_after_fork(self):
+        """ A forked child doesn't share its parent's writer lock """
+        import fcntl
+        state = self._make_state()
+        state.load_stats()
+        with state.shared.lock():
+            pid = os.fork()
+            if pid == 0:  # pragma: no cover
+                try:
+                    fcntl.flock(state.shared._open(),
+                                fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    os._exit(0)
+                os._exit(1)
+            _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+
+    def test_torn_write(self):
+        """ A write that was interrupted is not loaded """
+        from pyramid_webpack.shared import HEADER, MAGIC
+        state = self._make_state()
+        state.load_stats()
+        with open(self.settings['webpack.shared_stats'], 'r+b') as ofile:
+            ofile.write(HEADER.pack(MAGIC, 3, 0, 0, 0, 0))
+        self.assertIsNone(state.shared.load())
+        other = self._make_state()
+        self.assertEqual(other.load_stats(), self.stats)
+        self.assertEqual(other.shared.header()[0] % 2, 0)
+
+
+class TestIntegrity(TempDirTest):
+
+    """ Tests for chunk integrity hashes """
+
+    def setUp(self):
+        super(TestIntegrity, self).setUp()
+        bundle_dir = os.path.join(self._tempdir, 'bundles')
+        os.makedirs(bundle_dir)
+        with open(os.path.join(bundle_dir, 'main.js'), 'wb') as ofile:
+            ofile.write(b'var a = 1;')
+        self.stats = {
+            'status': 'done',
+            'chunks': {
+                'main': [
+                    {'name': 'main.js', 'path': '/static/main.js'},
+                    {'name': 'other.js', 'path': '/static/other.js',
+                     'integrity': 'sha384-fromstats'},
+                ],
+            },
+        }
+        self.settings = {
+            'webpack.stats_file': self._write('stats.json', self.stats),
+            'webpack.bundle_dir': bundle_dir,
+            'webpack.integrity': 'true',
+        }
+
+    def test_hash_in_background(self):
+        """ Chunks get integrity values once they are hashed """
+        import base64
+        import hashlib
+        state = WebpackState(self.settings)
+        state.load_stats()
+        state._hashing.wait(5)
+        main, other = state.load_snapshot().get_chunks('main')
+        digest = base64.b64encode(hashlib.sha384(b'var a = 1;').digest())
+        self.assertEqual(main.integrity,
+                         'sha384-' + digest.decode('ascii'))
+        self.assertEqual(other.integrity, 'sha384-fromstats')
+
+    def test_preload_waits(self):
+        """ Preloading waits for the chunks to be hashed """
+        state = WebpackState(self.settings)
+        snapshot = state.preload_stats()
+        self.assertIn('integrity', snapshot.get_chunks('main')[0])
+
+    def test_debug_reload(self):
+        """ Hashes are reused when debug mode re-parses an unchanged file """
+        self.settings['webpack.debug'] = 'true'
+        state = WebpackState(self.settings)
+        state.load_snapshot()
+        state._hashing.wait(5)
+        for _ in range(3):
+            chunk = state.load_snapshot().get_chunks('main')[0]
+            self.assertIn('integrity', chunk)
+
+    def test_default_bundle_dir(self):
+        """ Chunk files are found with the default bundle_dir """
+        state = WebpackState({'webpack.stats_file': self.settings[
+            'webpack.stats_file']})
+        path = os.path.join(self._tempdir, 'bundles', 'main.js')
+        self.assertEqual(state._chunk_file('main.js', path), path)
+
+    def test_hash_errors(self):
+        """ Chunks that can't be located are skipped """
+        from pyramid_webpack.integrity import hash_files
+
+        def locate(name):
+            """ Fail to locate one of the chunks """
+            if name == 'bad.js':
+                raise ValueError("Bad path")
+            return os.path.join(self._tempdir, 'bundles', name)
+        callback = MagicMock()
+        result = hash_files(['main.js', 'bad.js'], locate, 'sha384',
+                            callback)
+        result.wait(5)
+        self.assertTrue(result.successful())
+        hashes = callback.call_args[0][0]
+        self.assertEqual(list(hashes), ['main.js'])
+
+    def test_hash_cached(self):
+        """ Files are only hashed once while they are unchanged """
+        from mock import patch
+        from pyramid_webpack.integrity import hash_file
+        path = os.path.join(self._tempdir, 'bundles', 'main.js')
+        value = hash_file(path)
+        with patch('pyramid_webpack.integrity.hashlib') as hashlib:
+            self.assertEqual(hash_file(path), value)
+            self.assertFalse(hashlib.new.called)
+
+
 class TestWebpack(unittest.TestCase):
 
     """ Test class for the Webpack functions """
@@ -270,10 +943,15 @@ class TestWebpack(unittest.TestCase):
         self.webpack.state._load_stats = MagicMock()
         self.webpack.state._load_stats.return_value = self.stats
 
+    def _with_url(self, chunks):
+        """ Add the url that get_bundle() will generate to chunk dicts """
+        url = self.request.static_url.return_value
+        return [dict(c, url=url) for c in chunks]
+
     def test_get_bundle(self):
         """ get_bundle() returns the chunks with a 'url' key added """
         bundle = self.webpack.get_bundle('main')
-        self.assertEqual(bundle, self.stats['chunks']['main'])
+        self.assertEqual(bundle, self._with_url(self.stats['chunks']['main']))
 
     def test_filter_extensions(self):
         """ get_bundle() can filter by file extension """
@@ -283,7 +961,7 @@ class TestWebpack(unittest.TestCase):
         }
         self.stats['chunks']['main'].append(chunk)
         bundle = self.webpack.get_bundle('main', '.css')
-        self.assertEqual(bundle, [chunk])
+        self.assertEqual(bundle, self._with_url([chunk]))
 
     def test_filter_multiple_extensions(self):
         """ get_bundle() can filter by multiple file extensions """
@@ -293,7 +971,7 @@ class TestWebpack(unittest.TestCase):
         }
         self.stats['chunks']['main'].append(chunk)
         bundle = self.webpack.get_bundle('main', '.js .css')
-        self.assertEqual(bundle, self.stats['chunks']['main'])
+        self.assertEqual(bundle, self._with_url(self.stats['chunks']['main']))
 
     def test_filter_ignore(self):
         """ get_bundle() can ignore files by glob """
@@ -304,7 +982,7 @@ class TestWebpack(unittest.TestCase):
         self.stats['chunks']['main'].append(chunk)
         self.webpack.state.ignore = ['*.css']
         bundle = self.webpack.get_bundle('main')
-        self.assertEqual(bundle, self.stats['chunks']['main'][:1])
+        self.assertEqual(bundle, self._with_url(self.stats['chunks']['main'][:1]))
 
     def test_filter_ignore_re(self):
         """ get_bundle() can ignore files by regular expression """
@@ -315,7 +993,7 @@ class TestWebpack(unittest.TestCase):
         self.stats['chunks']['main'].append(chunk)
         self.webpack.state.ignore_re = [re.compile(r'.*\.css')]
         bundle = self.webpack.get_bundle('main')
-        self.assertEqual(bundle, self.stats['chunks']['main'][:1])
+        self.assertEqual(bundle, self._with_url(self.stats['chunks']['main'][:1]))
 
     def test_public_path(self):
         """ pulicPath in a chunk becomes the url """
@@ -324,6 +1002,95 @@ class TestWebpack(unittest.TestCase):
         bundle = self.webpack.get_bundle('main')
         self.assertEqual(bundle[0]['url'], url)
 
+    def test_public_path_no_static_view(self):
+        """ Chunks with a publicPath don't need a static view """
+        url = 'https://assets.cdn.com/main.js'
+        self.stats['chunks']['main'][0]['publicPath'] = url
+        self.request.registry.queryUtility.return_value.cache_busters = []
+        self.request.static_url.side_effect = ValueError(
+            "No static URL definition matching")
+        bundle = self.webpack.get_bundle('main')
+        self.assertEqual(bundle[0]['url'], url)
+
+    def test_url_prefix(self):
+        """ The url_prefix setting is used to build chunk urls """
+        self.webpack.state.url_prefix = 'https://cdn.com/assets/'
+        bundle = self.webpack.get_bundle('main')
+        self.assertEqual(bundle[0]['url'], 'https://cdn.com/assets/main.js')
+        self.assertFalse(self.request.static_url.called)
+
+    def test_stats_not_mutated(self):
+        """ get_bundle() doesn't modify the cached stats """
+        self.webpack.get_bundle('main')
+        self.assertNotIn('url', self.stats['chunks']['main'][0])
+
+    def test_chunk_immutable(self):
+        """ Chunks returned by get_bundle() can't be modified """
+        chunk = self.webpack.get_bundle('main')[0]
+        with self.assertRaises(TypeError):
+            chunk['url'] = 'foo'
+        with self.assertRaises(AttributeError):
+            chunk.url = 'foo'
+
+    def test_chunk_keys(self):
+        """ Chunks expose extra stats keys and hide missing ones """
+        chunk = pyramid_webpack.Chunk({'name': 'main.js', 'integrity': 'abc'})
+        self.assertEqual(chunk.integrity, 'abc')
+        self.assertEqual(dict(chunk), {'name': 'main.js', 'integrity': 'abc'})
+        self.assertNotIn('path', chunk)
+        with self.assertRaises(AttributeError):
+            chunk.path  # pylint: disable=W0104
+        with self.assertRaises(KeyError):
+            chunk['nope']  # pylint: disable=W0104
+
+    def test_bundle_json(self):
+        """ Bundles can be serialized to JSON """
+        self.webpack.state.url_prefix = 'https://cdn.com/assets/'
+        bundle = self.webpack.get_bundle('main')
+        self.assertEqual(json.loads(json.dumps(bundle)), [{
+            'name': 'main.js',
+            'path': '/static/main.js',
+            'url': 'https://cdn.com/assets/main.js',
+        }])
+
+    def test_chunk_copy(self):
+        """ Chunks can be copied and pickled """
+        import copy
+        import pickle
+        chunk = pyramid_webpack.Chunk({'name': 'main.js'})
+        self.assertEqual(copy.deepcopy(chunk), chunk)
+        self.assertEqual(pickle.loads(pickle.dumps(chunk)), chunk)
+
+    def test_shared_chunks(self):
+        """ Chunks that appear in several bundles are stored once """
+        self.stats['chunks']['other'] = [
+            dict(self.stats['chunks']['main'][0]),
+            {'name': 'other.js', 'path': '/static/other.js'},
+        ]
+        snapshot = self.webpack.state.load_snapshot()
+        self.assertIs(snapshot.get_chunks('main')[0],
+                      snapshot.get_chunks('other')[0])
+
+    def test_raw_stats_released(self):
+        """ Snapshots only keep the stats that are needed for bundles """
+        self.stats['modules'] = [{'id': 1, 'source': 'var a = 1;'}]
+        self.stats['hash'] = 'abc123'
+        stats = self.webpack.state.load_stats()
+        self.assertEqual(set(stats), set(['status', 'hash', 'chunks']))
+        self.assertIsInstance(stats['chunks']['main'][0],
+                              pyramid_webpack.Chunk)
+
+    def test_shared_chunk_urls(self):
+        """ A shared chunk gets one url per prefix for all bundles """
+        self.stats['chunks']['other'] = [
+            dict(self.stats['chunks']['main'][0]),
+        ]
+        snapshot = self.webpack.state.load_snapshot()
+        main = snapshot.get_urls('main', None, '/static/')
+        other = snapshot.get_urls('other', None, '/static/')
+        self.assertIs(main[0], other[0])
+        self.assertEqual(main[0]['url'], '/static/main.js')
+
     def test_bad_bundle(self):
         """ Getting a nonexistant bundle raises an exception """
         with self.assertRaises(KeyError):
@@ -343,6 +1110,37 @@ class TestWebpack(unittest.TestCase):
         with self.assertRaises(RuntimeError):
             self.webpack.get_bundle('main')
 
+    def test_index_reused(self):
+        """ get_bundle() only runs the ignore filters once per stats load """
+        self.webpack.get_bundle('main')
+        self.webpack.state.ignore = ['*.js']
+        bundle = self.webpack.get_bundle('main')
+        self.assertEqual(bundle, self._with_url(self.stats['chunks']['main']))
+
+    def test_index_rebuilt_on_reload(self):
+        """ The bundle index is rebuilt when the stats change """
+        self.webpack.get_bundle('main')
+        self.webpack.state.ignore = ['*.js']
+        self.webpack.state._load_stats.return_value = dict(self.stats)
+        snapshot = self.webpack.state.load_snapshot(cache=False)
+        self.assertEqual(snapshot.get_chunks('main'), ())
+
+    def test_stale(self):
+        """ Webpack.stale is True when serving the previous build """
+        self.webpack.state.serve_stale = True
+        self.webpack.state.load_stats()
+        self.webpack.state._load_stats.return_value = {'status': 'compiling'}
+        self.webpack.state.load_stats(cache=False)
+        self.assertEqual(self.webpack.get_bundle('main'),
+                         self._with_url(self.stats['chunks']['main']))
+        self.assertTrue(self.webpack.stale)
+
+    def test_not_stale_after_reload(self):
+        """ Webpack.stale is False if the stats were reloaded by someone else """
+        self.webpack.get_bundle('main')
+        self.webpack.state.load_stats(cache=False)
+        self.assertFalse(self.webpack.stale)
+
     def test_missing_state(self):
         """ Raise an error if no WebpackState found """
         req = MagicMock()
@@ -351,6 +1149,183 @@ class TestWebpack(unittest.TestCase):
             Webpack(req)
 
 
+class TestJinja2Extension(unittest.TestCase):
+
+    """ Tests for the jinja2 extension """
+
+    def setUp(self):
+        super(TestJinja2Extension, self).setUp()
+        from jinja2 import DictLoader, Environment
+        self.env = Environment(
+            loader=DictLoader({
+                'pure': "{% webpack 'main' %}{{ ASSET.url }}{% endwebpack %}",
+                'impure': "{% webpack 'main' %}{{ ASSET.url }}{{ x }}"
+                          "{% endwebpack %}",
+                'same_line': "{% webpack 'main' %}A{{ ASSET.url }}"
+                             "{% endwebpack %}|{% webpack 'main' %}B"
+                             "{{ ASSET.url }}{% endwebpack %}",
+                'filter': "{% webpack 'main' %}{{ ASSET.url|nonce }}"
+                          "{% endwebpack %}",
+            }),
+            extensions=['pyramid_webpack.jinja2ext:WebpackExtension'])
+        self.request = MagicMock()
+        self.webpack = self.request.webpack.return_value
+        self.webpack.url_prefix = 'http://localhost/'
+        self.webpack.get_bundle.return_value = [{'url': 'main.js'}]
+
+    def _render(self, name, **kwargs):
+        """ Render a template """
+        template = self.env.get_template(name)
+        return template.render(request=self.request, **kwargs)
+
+    def test_render_cache(self):
+        """ Rendered webpack blocks are cached per stats snapshot """
+        self.assertEqual(self._render('pure'), 'main.js')
+        self.assertEqual(self._render('pure'), 'main.js')
+        self.assertEqual(self.webpack.get_bundle.call_count, 1)
+
+    def test_render_cache_invalidate(self):
+        """ The render cache is invalidated when the stats change """
+        self._render('pure')
+        self.webpack.snapshot = object()
+        self.webpack.get_bundle.return_value = [{'url': 'other.js'}]
+        self.assertEqual(self._render('pure'), 'other.js')
+
+    def _setup_inline(self):
+        """ Create a registry with a WebpackState that inlines bundles """
+        from pyramid import testing
+        config = testing.setUp()
+        self.addCleanup(testing.tearDown)
+        state = WebpackState({
+            'webpack.inline_bundles': 'true',
+            'webpack.url_prefix': '/static/',
+        })
+        state._load_stats = MagicMock()
+        state._load_stats.return_value = {
+            'status': 'done',
+            'chunks': {'main': [{'name': 'main.js'}]},
+        }
+        config.registry.webpack = {'DEFAULT': state}
+        return state
+
+    def test_inline_bundle(self):
+        """ Bundles can be resolved when the template is compiled """
+        self._setup_inline()
+        self.assertEqual(self._render('impure', x='a'), '/static/main.jsa')
+        self.assertFalse(self.webpack.get_bundle.called)
+
+    def test_inline_bundle_rebuild(self):
+        """ Inlined bundles are not used after the stats change """
+        state = self._setup_inline()
+        self._render('pure')
+        state._load_stats.return_value = {
+            'status': 'done',
+            'chunks': {'main': [{'name': 'other.js'}]},
+        }
+        state.load_stats(cache=False)
+        self._render('pure')
+        self.assertTrue(self.webpack.get_bundle.called)
+        # The template is recompiled with the new build
+        self.assertEqual(self._render('pure'), '/static/other.js')
+
+    def test_render_cache_record(self):
+        """ Cached webpack blocks still record the bundle they used """
+        self._render('pure')
+        self._render('pure')
+        self.assertEqual(self.webpack.record_bundle.call_count, 1)
+        args = self.webpack.record_bundle.call_args[0]
+        self.assertEqual(args[:3], ('main', None, ({'url': 'main.js'},)))
+
+    def test_render_cache_same_line(self):
+        """ Blocks on the same line are cached separately """
+        self.assertEqual(self._render('same_line'), 'Amain.js|Bmain.js')
+
+    def test_render_cache_recompile(self):
+        """ Edited templates don't use the cached output of the old blocks """
+        self._render('pure')
+        self.env.loader.mapping['pure'] = \
+            "{% webpack 'main' %}x{{ ASSET.url }}{% endwebpack %}"
+        self.env.cache.clear()
+        self.assertEqual(self._render('pure'), 'xmain.js')
+
+    def test_render_cache_filter(self):
+        """ Blocks that use filters are not cached """
+        from jinja2 import pass_context
+
+        @pass_context
+        def nonce(ctx, value):
+            """ Add a nonce from the context """
+            return '{0}?n={1}'.format(value, ctx['n'])
+        self.env.filters['nonce'] = nonce
+        self.assertEqual(self._render('filter', n=1), 'main.js?n=1')
+        self.assertEqual(self._render('filter', n=2), 'main.js?n=2')
+
+    def test_render_cache_impure(self):
+        """ Blocks that use other variables are not cached """
+        self.assertEqual(self._render('impure', x='a'), 'main.jsa')
+        self.assertEqual(self._render('impure', x='b'), 'main.jsb')
+
+
+try:
+    import pyramid_debugtoolbar  # pylint: disable=W0611
+    HAS_DEBUGTOOLBAR = True
+except ImportError:
+    HAS_DEBUGTOOLBAR = False
+
+
+@unittest.skipIf(not HAS_DEBUGTOOLBAR, "pyramid_debugtoolbar not installed")
+class TestDebugToolbar(TempDirTest):
+
+    """ Tests for the debug toolbar panel """
+
+    def setUp(self):
+        super(TestDebugToolbar, self).setUp()
+        from pyramid_webpack.debugtoolbar import WebpackDebugPanel
+        stats_file = self._write('stats.json', {
+            'status': 'done',
+            'chunks': {'main': [{'name': 'main.js'}, {'name': 'main.css'}]},
+        })
+        self.request = MagicMock()
+        self.request.registry.webpack = {
+            'DEFAULT': WebpackState({
+                'webpack.stats_file': stats_file,
+                'webpack.url_prefix': '/static/',
+            }),
+        }
+        self.panel = WebpackDebugPanel(self.request)
+
+    def test_record_bundles(self):
+        """ The panel records the bundles resolved by a request """
+        Webpack(self.request).get_bundle('main', '.js')
+        self.panel.process_response(None)
+        self.assertTrue(self.panel.has_content)
+        configs = self.panel.data['configs']
+        self.assertEqual(len(configs), 1)
+        self.assertTrue(configs[0]['parsed'])
+        self.assertEqual(configs[0]['bundles'][0]['name'], 'main')
+        self.assertEqual(configs[0]['bundles'][0]['chunks'], 1)
+
+    def test_record_cached_bundles(self):
+        """ The panel records bundles that were rendered from a cache """
+        webpack = Webpack(self.request)
+        webpack.record_bundle('main', None, webpack.get_bundle('main'))
+        self.panel.process_response(None)
+        bundles = self.panel.data['configs'][0]['bundles']
+        self.assertEqual(len(bundles), 2)
+        self.assertEqual(bundles[1]['chunks'], 2)
+
+    def test_render_template(self):
+        """ The panel template renders the recorded data """
+        from mako.template import Template
+        Webpack(self.request).get_bundle('main')
+        self.panel.process_response(None)
+        path = os.path.join(os.path.dirname(pyramid_webpack.__file__),
+                            'templates', 'debugtoolbar.dbtmako')
+        html = Template(filename=path).render(**self.panel.data)
+        self.assertIn('read from disk', html)
+        self.assertIn('main', html)
+
+
 def _get_bundle(request):
     """ Route view for the test webapp """
     config = request.matchdict['config']
@@ -363,6 +1338,276 @@ def _get_bundle(request):
         return bundle
 
 
+@unittest.skipIf(not HAS_STATIC_VIEW_API, "Pyramid 2.0 or later is required")
+class TestStaticView(TempDirTest):
+
+    """ Tests for serving the bundle files """
+
+    def setUp(self):
+        super(TestStaticView, self).setUp()
+        self.bundle_dir = os.path.join(self._tempdir, 'bundles')
+        os.makedirs(self.bundle_dir)
+        self._write_bundle('main.js', b'var a = 1;' * 100)
+        self.stats = {
+            'status': 'done',
+            'chunks': {
+                'main': [{'name': 'main.js', 'path': '/static/main.js'}],
+            },
+        }
+
+    def _write_bundle(self, filename, data):
+        """ Write a file to the bundle directory """
+        with open(os.path.join(self.bundle_dir, filename), 'wb') as ofile:
+            ofile.write(data)
+
+    def _make_app(self, **kwargs):
+        """ Create a WSGI app serving the bundle directory """
+        settings = {
+            'webpack.stats_file': self._write('stats.json', self.stats),
+            'webpack.bundle_dir': self.bundle_dir,
+        }
+        settings.update(('webpack.' + k, v) for k, v in kwargs.items())
+        config = Configurator(settings=settings)
+        config.include('pyramid_webpack')
+        return config.make_wsgi_app()
+
+    def _get(self, app, path, **headers):
+        """
+        Make a request to the app
+
+        Doesn't use webtest because it decodes gzipped responses.
+
+        """
+        from webob import Request
+        return Request.blank(path, headers=headers).get_response(app)
+
+    def test_serve(self):
+        """ Bundle files are served from the static view """
+        app = self._make_app()
+        res = self._get(app, '/webpack-DEFAULT/main.js')
+        self.assertEqual(res.body, b'var a = 1;' * 100)
+
+    def test_content_encodings(self):
+        """ Precompressed files are served if the client accepts them """
+        import gzip
+        import io
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as ofile:
+            ofile.write(b'var a = 1;' * 100)
+        self._write_bundle('main.js.gz', buf.getvalue())
+        app = self._make_app(content_encodings='gzip')
+        res = self._get(app, '/webpack-DEFAULT/main.js',
+                        **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(res.body, buf.getvalue())
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        res = self._get(app, '/webpack-DEFAULT/main.js')
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(res.body, b'var a = 1;' * 100)
+
+    def test_immutable_hashed(self):
+        """ Content-hashed chunks are cached forever """
+        self._write_bundle('main.0123456789abcdef.js', b'var a = 1;')
+        self.stats['chunks']['main'] = [{
+            'name': 'main.0123456789abcdef.js',
+            'path': '/static/main.0123456789abcdef.js',
+        }]
+        app = self._make_app(immutable_hashed='true')
+        res = self._get(app, '/webpack-DEFAULT/main.0123456789abcdef.js')
+        self.assertEqual(res.body, b'var a = 1;')
+        self.assertEqual(res.headers['Cache-Control'],
+                         'public, max-age=31536000, immutable')
+
+    def test_etag(self):
+        """ Unhashed files get an ETag from the build hash """
+        self.stats['hash'] = 'abc123'
+        app = self._make_app(immutable_hashed='true')
+        res = self._get(app, '/webpack-DEFAULT/main.js')
+        self.assertEqual(res.headers['ETag'], '"abc123"')
+        self.assertEqual(res.headers['Cache-Control'], 'max-age=3600')
+        res = self._get(app, '/webpack-DEFAULT/main.js',
+                        **{'If-None-Match': '"abc123"'})
+        self.assertEqual(res.status_int, 304)
+        self.assertEqual(res.body, b'')
+
+    def test_memory_cache(self):
+        """ Small files are served from memory until the build changes """
+        self.stats['hash'] = 'abc123'
+        app = self._make_app(memory_cache_size='10000')
+        res = self._get(app, '/webpack-DEFAULT/main.js')
+        self.assertEqual(res.body, b'var a = 1;' * 100)
+        # Same size and mtime, so only a new build will pick it up
+        path = os.path.join(self.bundle_dir, 'main.js')
+        st = os.stat(path)
+        self._write_bundle('main.js', b'var b = 2;' * 100)
+        os.utime(path, (st.st_atime, st.st_mtime))
+        res = self._get(app, '/webpack-DEFAULT/main.js')
+        self.assertEqual(res.body, b'var a = 1;' * 100)
+        self.stats['hash'] = 'def456'
+        self._write('stats.json', self.stats)
+        app.registry.webpack['DEFAULT'].load_stats(cache=False)
+        res = self._get(app, '/webpack-DEFAULT/main.js')
+        self.assertEqual(res.body, b'var b = 2;' * 100)
+
+    def test_debug_no_reload(self):
+        """ Asset requests use the cached stats in debug mode """
+        from mock import patch
+        self.stats['hash'] = 'abc123'
+        app = self._make_app(immutable_hashed='true', debug='true')
+        state = app.registry.webpack['DEFAULT']
+        state.load_stats()
+        with patch.object(state, '_reload_stats') as reload_stats:
+            for _ in range(3):
+                res = self._get(app, '/webpack-DEFAULT/main.js')
+                self.assertEqual(res.etag, 'abc123')
+        self.assertFalse(reload_stats.called)
+
+    def test_missing_stats(self):
+        """ Files are served without build headers if there are no stats """
+        app = self._make_app(immutable_hashed='true',
+                             memory_cache_size='10000')
+        os.unlink(os.path.join(self._tempdir, 'stats.json'))
+        res = self._get(app, '/webpack-DEFAULT/main.js')
+        self.assertEqual(res.status_int, 200)
+        self.assertEqual(res.body, b'var a = 1;' * 100)
+        self.assertIsNone(res.etag)
+
+    def test_memory_cache_lru(self):
+        """ The least recently used files are evicted from the cache """
+        from pyramid_webpack.static import AssetCache
+        cache = AssetCache(10, 5)
+        cache.get('build', 'a')
+        cache.put('build', 'a', b'aaaa')
+        cache.put('build', 'b', b'bbbb')
+        cache.get('build', 'a')
+        cache.put('build', 'c', b'cccc')
+        cache.put('build', 'd', b'dddddd')
+        self.assertEqual(cache.get('build', 'a'), b'aaaa')
+        self.assertIsNone(cache.get('build', 'b'))
+        self.assertIsNone(cache.get('build', 'd'))
+        self.assertEqual(cache.size, 8)
+
+    def test_x_sendfile(self):
+        """ X-Sendfile responses have the path to the file """
+        app = self._make_app(sendfile='x-sendfile')
+        res = self._get(app, '/webpack-DEFAULT/main.js')
+        self.assertEqual(res.headers['X-Sendfile'],
+                         os.path.join(self.bundle_dir, 'main.js'))
+        self.assertEqual(res.body, b'')
+
+    def test_x_accel_redirect(self):
+        """ X-Accel-Redirect responses have the internal url of the file """
+        app = self._make_app(sendfile='x-accel-redirect',
+                             sendfile_prefix='/internal/webpack')
+        res = self._get(app, '/webpack-DEFAULT/main.js')
+        self.assertEqual(res.headers['X-Accel-Redirect'],
+                         '/internal/webpack/main.js')
+        self.assertTrue(res.content_type.endswith('javascript'))
+
+    def test_x_accel_redirect_prefix(self):
+        """ X-Accel-Redirect requires a prefix """
+        with self.assertRaises(ValueError):
+            WebpackState({'webpack.sendfile': 'x-accel-redirect'})
+
+    def test_etag_not_found(self):
+        """ Files that don't exist are not found even with an ETag """
+        self.stats['hash'] = 'abc123'
+        app = self._make_app(immutable_hashed='true')
+        res = self._get(app, '/webpack-DEFAULT/nope.js',
+                        **{'If-None-Match': '"abc123"'})
+        self.assertEqual(res.status_int, 404)
+
+
+class TestPreloadLinks(TempDirTest):
+
+    """ Tests for the preload Link header tween """
+
+    def setUp(self):
+        super(TestPreloadLinks, self).setUp()
+        self.stats = {
+            'status': 'done',
+            'hash': 'abc123',
+            'chunks': {
+                'main': [
+                    {'name': 'main.js', 'path': '/static/main.js'},
+                    {'name': 'main.css', 'path': '/static/main.css'},
+                    {'name': 'logo.png', 'path': '/static/logo.png'},
+                ],
+            },
+        }
+
+    def _make_app(self, **kwargs):
+        """ Create a WSGI app with a route that uses the main bundle """
+        from pyramid.response import Response
+        settings = {
+            'webpack.stats_file': self._write('stats.json', self.stats),
+            'webpack.url_prefix': '/static/',
+            'webpack.preload_links': 'true',
+        }
+        settings.update(('webpack.' + k, v) for k, v in kwargs.items())
+        config = Configurator(settings=settings)
+        config.include('pyramid_webpack')
+
+        def view(request):
+            """ Use the main bundle twice """
+            request.webpack().get_bundle('main')
+            request.webpack().get_bundle('main', ['.js'])
+            return Response('ok')
+        config.add_route('home', '/')
+        config.add_view(view, route_name='home')
+        return config.make_wsgi_app()
+
+    def _get(self, app, path, early_hints=None):
+        """ Make a request to the app """
+        from webob import Request
+        request = Request.blank(path)
+        if early_hints is not None:
+            request.environ['wsgi.early_hints'] = early_hints
+        return request.get_response(app)
+
+    def test_link_headers(self):
+        """ Scripts and stylesheets used by the response are preloaded """
+        res = self._get(self._make_app(), '/')
+        self.assertEqual(res.headers.getall('Link'), [
+            '</static/main.js>; rel=preload; as=script',
+            '</static/main.css>; rel=preload; as=style',
+        ])
+
+    def test_disabled(self):
+        """ No Link headers are added by default """
+        res = self._get(self._make_app(preload_links='false'), '/')
+        self.assertNotIn('Link', res.headers)
+
+    def test_early_hints(self):
+        """ The links a route used last time are sent as early hints """
+        app = self._make_app()
+        hints = MagicMock()
+        self._get(app, '/', hints)
+        self.assertFalse(hints.called)
+        self._get(app, '/', hints)
+        hints.assert_called_once_with([
+            ('Link', '</static/main.js>; rel=preload; as=script'),
+            ('Link', '</static/main.css>; rel=preload; as=style'),
+        ])
+
+    def test_early_hints_new_build(self):
+        """ Links from an old build are not sent as early hints """
+        from pyramid_webpack.preload import PreloadLinks
+        state = WebpackState({'webpack.stats_file': self._write(
+            'stats.json', self.stats)})
+        registry = MagicMock()
+        registry.webpack = {'DEFAULT': state}
+        preload = PreloadLinks(registry)
+        preload.remember('home', [('DEFAULT', 'abc123', '<main.js>')])
+        self.assertEqual(preload.get('home'), [])
+        state.load_stats()
+        self.assertEqual(preload.get('home'), ['<main.js>'])
+        self.stats['hash'] = 'def456'
+        self._write('stats.json', self.stats)
+        state.load_stats(cache=False)
+        self.assertEqual(preload.get('home'), [])
+
+
 class TestWebapp(TempDirTest):
     """ Pyramid app tests """
 
@@ -431,6 +1676,23 @@ class TestWebapp(TempDirTest):
         self.assertEqual(bundle[0]['path'], expected['path'])
         self.assertTrue('url' in bundle[0])
 
+    def test_url(self):
+        """ Chunk urls match the ones generated by request.static_url() """
+        res = self.app.get('/bundle/DEFAULT/main')
+        bundle = json.loads(res.body.decode('utf-8'))
+        self.assertEqual(bundle[0]['url'],
+                         'http://localhost/webpack-DEFAULT/main.js')
+
+    def test_url_per_host(self):
+        """ Chunk urls are generated for each application url """
+        self.app.get('/bundle/DEFAULT/main')
+        res = self.app.get('/bundle/DEFAULT/main',
+                           extra_environ={'HTTP_HOST': 'example.com',
+                                          'wsgi.url_scheme': 'https'})
+        bundle = json.loads(res.body.decode('utf-8'))
+        self.assertEqual(bundle[0]['url'],
+                         'https://example.com/webpack-DEFAULT/main.js')
+
     def test_jinja2(self):
         """ The jinja2 extension can use 'webasset' blocks """
         res = self.app.get('/bundle/DEFAULT/main?renderer=paths.jinja2')